@@ -2,7 +2,9 @@
 
 """ json api definition """
 
-# import json
+import json
+import base64
+import binascii
 # import logging
 # import inspect
 # import funtools
@@ -66,3 +68,55 @@ class Page(object):
             )
 
     __repr__ = __str__
+
+
+def encode_cursor(values):
+    """ 将 seek 字段值编码为不透明游标 """
+    s = json.dumps(list(values), separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, size):
+    """ 解析游标，返回 seek 字段值 tuple
+
+    :param size-seek 字段个数，游标必须是同样个数的 str/int/float 值
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, binascii.Error):
+        raise APIValueError('after', 'Invalid cursor.')
+    if (not isinstance(values, list) or len(values) != size or
+            not all(isinstance(v, (str, int, float)) and
+                    not isinstance(v, bool) for v in values)):
+        raise APIValueError('after', 'Invalid cursor.')
+    return tuple(values)
+
+
+class CursorPage(object):
+    """ 键集分页，无需总条数
+
+    items 需多查询一条（page_size + 1）用于判断是否有下一页，多出的一条会被移除
+    """
+    def __init__(self, items, seek, after=None, page_size=_PAGE_SIZE):
+        self.page_size = page_size
+        self.after = after or None
+        self.has_prev = self.after is not None
+        self.has_next = len(items) > page_size
+        del items[page_size:]
+        if self.has_next:
+            last = items[-1]
+            self.next_cursor = encode_cursor(getattr(last, k) for k in seek)
+        else:
+            self.next_cursor = None
+
+    def __str__(self):
+
+        return "page_size: {0}, after: {1}, has_next: {2}, "\
+            "next_cursor: {3}".format(
+                self.page_size,
+                self.after,
+                self.has_next,
+                self.next_cursor
+            )
+
+    __repr__ = __str__
@@ -5,12 +5,16 @@ import os
 import json
 import time
 import orm
+import metrics
+import limiter
+import compress
 
 from datetime import datetime
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
-from webFrame import add_routes, add_static
-from functions import logger
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from webFrame import add_routes, add_static, response_cache
+from functions import logger, access_logger
+from models import User, Blog, Comment
 from config.env import CONF
 
 import functions as Glo
@@ -19,15 +23,30 @@ Glo.exception_set(True)
 
 
 def init_jinja2(app, **kw):
+    """ 初始化模板环境
+
+    :param production-生产模式：不检查模板文件修改，编译后的模板常驻内存，
+        启动时预编译全部模板
+    :param bytecode_cache-字节码缓存目录，重启后直接加载编译结果
+    :param globals-模板全局函数，如 asset_url
+    """
     logger.debug('init jinja2...')
+    production = kw.get('production', False)
     options = dict(
         autoescape=kw.get('autoescape', True),
         block_start_string=kw.get('block_start_string', '{%'),
         block_end_string=kw.get('block_end_string', '%}'),
         variable_start_string=kw.get('variable_start_string', '{{'),
         variable_end_string=kw.get('variable_end_string', '}}'),
-        auto_reload=kw.get('auto_reload', True)
+        auto_reload=kw.get('auto_reload', not production)
     )
+    if production:
+        # 不限制缓存的模板数量
+        options['cache_size'] = -1
+    bytecode_cache = kw.get('bytecode_cache')
+    if bytecode_cache:
+        os.makedirs(bytecode_cache, exist_ok=True)
+        options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache)
     path = kw.get('path', None)
     if path is None:
         path = os.path.join(os.path.dirname(
@@ -39,13 +58,30 @@ def init_jinja2(app, **kw):
     if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    env.globals.update(kw.get('globals', {}))
+    if production:
+        precompile_templates(env)
     app['__templating__'] = env
+    return env
+
+
+def precompile_templates(env):
+    """ 编译全部模板并放入模板缓存，有字节码缓存时同时写入 """
+    names = env.list_templates(filter_func=lambda n: not n.startswith('.'))
+    for name in names:
+        env.get_template(name)
+    logger.info('precompiled %s templates', len(names))
+    return names
 
 
 async def logger_factory(app, handler):
     async def loggerx(request):
-        logger.debug('Request:{} {}'.format(request.method, request.path))
-        return (await handler(request))
+        start = time.perf_counter()
+        resp = await handler(request)
+        access_logger.info(
+            '%s %s %s %.1fms', request.method, request.path_qs,
+            getattr(resp, 'status', '-'), (time.perf_counter() - start) * 1000)
+        return resp
     return loggerx
 
 
@@ -63,11 +99,88 @@ async def data_factory(app, handler):
     return parse_data
 
 
+def _route_name(request):
+    """ 路由模板，如 /blog/{id}，未匹配的请求统一为 unmatched """
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else 'unmatched'
+
+
+async def metrics_factory(app, handler):
+    """ 统计每个路由的请求数、状态码、耗时和 SQL 语句数 """
+    async def record(request):
+        start = time.perf_counter()
+        stats, token = metrics.request_scope()
+        status = 500
+        try:
+            resp = await handler(request)
+            status = resp.status
+            return resp
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            route = _route_name(request)
+            metrics.end_request(route, token, stats)
+            metrics.REQUESTS.inc(request.method, route, str(status))
+            metrics.REQUEST_SECONDS.observe(
+                time.perf_counter() - start, request.method, route)
+    return record
+
+
+async def admission_factory(app, handler):
+    """ 准入控制：按客户端限流，按路由限制并发，超出时快速失败 """
+    admission = app['__admission__']
+
+    async def admit(request):
+        try:
+            route_limiter = admission.admit(_route_name(request), request.remote)
+            if route_limiter is not None:
+                await route_limiter.acquire()
+        except limiter.Rejected as e:
+            logger.warning('%s %s rejected: %s', request.method, request.path, e)
+            return web.Response(
+                status=e.status, reason=e.reason,
+                headers={'Retry-After': str(e.retry_after)})
+        if route_limiter is None:
+            return (await handler(request))
+        start = time.perf_counter()
+        try:
+            return (await handler(request))
+        finally:
+            route_limiter.release(time.perf_counter() - start)
+    return admit
+
+
+def json_default(o):
+    """ json 序列化对象，只读记录使用 _asdict """
+    if isinstance(o, orm.Record):
+        return o._asdict()
+    return o.__dict__
+
+
 async def response_factory(app, handler):
     """ 响应工厂 """
     async def response(request):
+        resp = await build(request)
+        # 处理函数通过 functions.not_modified 设置的校验值
+        validators = getattr(request, '__validators__', None)
+        if validators is not None and resp.status in (200, 304):
+            etag, last_modified = validators
+            resp.headers['ETag'] = etag
+            if last_modified:
+                resp.last_modified = last_modified
+            # 可以缓存，但每次使用前要验证
+            resp.headers.setdefault('Cache-Control', 'no-cache')
+        return resp
+
+    async def build(request):
         logger.debug('Response handler...')
-        r = await handler(request)
+        try:
+            r = await handler(request)
+        except orm.PoolTimeoutError as e:
+            # 数据库连接池繁忙，快速失败
+            logger.warning(e)
+            return web.HTTPServiceUnavailable(headers={'Retry-After': '1'})
         if isinstance(r, web.StreamResponse):
             return r
         if isinstance(r, bytes):
@@ -80,7 +193,7 @@ async def response_factory(app, handler):
                 return web.HTTPFound(r[9:])
             # 字符串还可用直接返回，用于wx验证
             resp = web.Response(body=r.encode('utf-8'))
-            logger.debug("r=%s" % r)
+            logger.debug("r=%s", r)
             resp.content_type = 'text/html;charset=utf-8'
             return resp
 
@@ -91,13 +204,17 @@ async def response_factory(app, handler):
                         body=json.dumps(
                             r,
                             ensure_ascii=False,
-                            default=lambda o: o.__dict__).encode('utf-8')
+                            default=json_default).encode('utf-8')
                     )
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
                 r['__user__'] = request.__user__
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
+                start = time.perf_counter()
+                body = app['__templating__'].get_template(template).render(**r).encode('utf-8')
+                metrics.TEMPLATE_SECONDS.observe(
+                    time.perf_counter() - start, template)
+                resp = web.Response(body=body)
                 resp.content_type = 'text/html;charset=utf-8'
                 return resp
         if isinstance(r, int) and (100 <= r < 600):
@@ -113,24 +230,123 @@ async def response_factory(app, handler):
     return response
 
 
+async def identity_map_factory(app, handler):
+    """ 请求级别的对象缓存，同一请求内按主键查询同一行只查一次 """
+    async def identity_map(request):
+        with orm.identity_scope():
+            return (await handler(request))
+    return identity_map
+
+
 async def auth_factory(app, handler):
     """ 权限工厂，解析cookie,将用户绑定到request对象 """
     async def auth(request):
-        logger.debug("check user: {0} {1}".format(request.method, request.path))
+        logger.debug("check user: %s %s", request.method, request.path)
         request.__user__ = None
         cookie_str = request.cookies.get(Glo._COOKIE_NAME)
         if cookie_str:
             user = await Glo.cookie2user(cookie_str)
             if user:
-                logger.debug('set current user: {0}'.format(user.email)) 
+                logger.debug('set current user: %s', user.email)
                 request.__user__ = user
         if (request.path.startswith('/manage/') and
                 (request.__user__ is None or not request.__user__.admin)):
             return web.HTTPFound('/signin')
-        return (await handler(request))
+        # 登录用户写入后短时间内的读请求走主库
+        with orm.session_scope(request.__user__ and request.__user__.id):
+            return (await handler(request))
     return auth
 
 
+def _cache_key(request, policy):
+    """ 响应缓存键：路径、查询参数、vary 请求头、压缩编码和用户，匿名用户共用 """
+    user = request.__user__
+    return (
+        request.path,
+        tuple(sorted(request.query.items())),
+        tuple(request.headers.get(h) for h in policy['vary']),
+        compress.negotiate(request.headers.get('Accept-Encoding')),
+        user.id if user else None
+    )
+
+
+async def cache_factory(app, handler):
+    """ 响应缓存，只缓存 @cached 路由的 GET 200 响应，不缓存设置了 cookie 的响应 """
+    async def cache(request):
+        route = request.match_info.handler
+        policy = getattr(route, 'cache_policy', None)
+        if policy is None or request.method != 'GET':
+            return (await handler(request))
+
+        async def build():
+            resp = await handler(request)
+            if (type(resp) is not web.Response or resp.status != 200 or
+                    'Set-Cookie' in resp.headers or
+                    not isinstance(resp.body, bytes)):
+                return resp, None, None
+            headers = tuple((k, v) for k, v in resp.headers.items()
+                            if k != 'Content-Length')
+            return resp, bytes(resp.body), headers
+
+        resp, body, headers = await response_cache.fetch(
+            _cache_key(request, policy), policy, build)
+        if resp is None:
+            if_none_match = request.headers.get('If-None-Match')
+            etag = dict(headers).get('ETag')
+            if (if_none_match is not None and etag is not None and
+                    Glo.etag_matches(if_none_match, etag)):
+                resp = web.Response(status=304, headers=[
+                    (k, v) for k, v in headers
+                    if k in ('ETag', 'Last-Modified', 'Cache-Control')])
+            else:
+                resp = web.Response(body=body, headers=headers)
+        return resp
+    return cache
+
+
+def _add_vary(headers, name):
+    """ 在 Vary 中加入请求头名称，已存在时不重复添加 """
+    vary = headers.get('Vary')
+    if not vary:
+        headers['Vary'] = name
+    elif name.lower() not in (v.strip().lower() for v in vary.split(',')):
+        headers['Vary'] = '{0}, {1}'.format(vary, name)
+
+
+async def compression_factory(app, handler):
+    """ 响应压缩，在响应缓存之内，缓存保存的是压缩后的内容 """
+    compressor = app['__compressor__']
+
+    async def compression(request):
+        resp = await handler(request)
+        if type(resp) is not web.Response or 'Content-Encoding' in resp.headers:
+            return resp
+        encoding = compress.negotiate(request.headers.get('Accept-Encoding'))
+        etag = resp.headers.get('ETag')
+        if resp.status == 304:
+            # 客户端缓存的是压缩后的响应时，返回相同的 ETag
+            if (encoding is not None and etag is not None and
+                    Glo.encoded_etag(etag, encoding) in
+                    request.headers.get('If-None-Match', '')):
+                resp.headers['ETag'] = Glo.encoded_etag(etag, encoding)
+                _add_vary(resp.headers, 'Accept-Encoding')
+            return resp
+        if (resp.status != 200 or not isinstance(resp.body, bytes) or
+                not compress.compressible(resp.content_type)):
+            return resp
+        _add_vary(resp.headers, 'Accept-Encoding')
+        if encoding is None:
+            return resp
+        body = compressor.compress(resp.body, encoding)
+        if body is not None:
+            resp.body = body
+            resp.headers['Content-Encoding'] = encoding
+            if etag is not None:
+                resp.headers['ETag'] = Glo.encoded_etag(etag, encoding)
+        return resp
+    return compression
+
+
 def datetime_filter(t):
     """ datetime 过滤器 """
     delta = int(time.time() - t)
@@ -149,20 +365,56 @@ def datetime_filter(t):
 async def init(loop):
     await orm.create_pool(
         loop=loop,
-        host=CONF['db']['host'],
-        port=CONF['db']['port'],
-        user=CONF['db']['user'],
-        password=CONF['db']['password'],
-        db=CONF['db']['dbName']
+        backend=CONF['db'].get('backend', 'mysql'),
+        host=CONF['db'].get('host'),
+        port=CONF['db'].get('port'),
+        user=CONF['db'].get('user'),
+        password=CONF['db'].get('password'),
+        db=CONF['db'].get('dbName'),
+        path=CONF['db'].get('path'),
+        readers=CONF['db'].get('readers', 4),
+        replicas=CONF['db'].get('replicas'),
+        read_policy=CONF['db'].get('read_policy', 'round_robin'),
+        read_your_writes=CONF['db'].get('read_your_writes', 5),
+        minsize=CONF['db'].get('minsize', 1),
+        maxsize=CONF['db'].get('maxsize', 10),
+        acquire_timeout=CONF['db'].get('acquire_timeout'),
+        pool_recycle=CONF['db'].get('pool_recycle', 3600),
+        ping_interval=CONF['db'].get('ping_interval', 30)
     )
+    if CONF['db'].get('create_tables'):
+        # 按模型定义建表，用于 SQLite 等本地部署
+        await orm.create_tables(User, Blog, Comment)
+    orm.start_count_reconciler(CONF['db'].get('count_interval', 60))
+    if CONF['db'].get('track_queries'):
+        orm.track_queries()
 
-    app = web.Application(loop=loop, middlewares=[
-        logger_factory, auth_factory, response_factory
-    ])
+    middlewares = [
+        logger_factory, metrics_factory, admission_factory,
+        identity_map_factory, auth_factory, cache_factory, response_factory
+    ]
+    compression = CONF.get('compression', {})
+    if compression.get('enabled', True):
+        middlewares.insert(-1, compression_factory)
+    app = web.Application(loop=loop, middlewares=middlewares)
+    app['__compressor__'] = compress.Compressor(
+        min_size=compression.get('min_size', 1024),
+        gzip_level=compression.get('gzip_level', 5),
+        brotli_quality=compression.get('brotli_quality', 4)
+    )
+    app['__admission__'] = limiter.AdmissionControl(CONF.get('limits'))
+    metrics.install(app['__admission__'])
+    response_cache.max_entries = CONF.get('cache', {}).get('max_entries', 1024)
 
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
-    add_routes(app, 'handlers')
     add_static(app)
+    init_jinja2(
+        app,
+        filters=dict(datetime=datetime_filter),
+        globals=dict(asset_url=app['__static__'].url),
+        production=CONF.get('templates', {}).get('production', False),
+        bytecode_cache=CONF.get('templates', {}).get('bytecode_cache')
+    )
+    add_routes(app, 'handlers')
     try:
         srv = await loop.create_server(
             app.make_handler(),
@@ -174,6 +426,7 @@ async def init(loop):
     logger.info(f"server started at http://{CONF['host']}:{CONF['port']}")
     return srv
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(init(loop))
+    loop.run_forever()
@@ -0,0 +1,17 @@
+# coding:utf-8
+""" 数据库后端
+
+每个后端提供与 aiomysql 一致的连接池、连接和游标接口，orm 通过后端
+创建连接池、获取游标类型和转换SQL占位符
+"""
+
+
+def get_backend(name):
+    """ 按名称获取后端: mysql 或 sqlite """
+    if name == 'mysql':
+        from backend.mysql import MySQLBackend
+        return MySQLBackend()
+    if name == 'sqlite':
+        from backend.sqlite import SQLiteBackend
+        return SQLiteBackend()
+    raise ValueError('Unknown database backend: {}'.format(name))
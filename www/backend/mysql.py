@@ -0,0 +1,85 @@
+# coding:utf-8
+""" aiomysql 后端 """
+
+import aiomysql
+from functions import logger
+
+
+class MySQLBackend(object):
+    """ MySQL 后端 """
+    name = 'mysql'
+    placeholder = '%s'  # 驱动使用的参数占位符
+    # 游标类型: dict 每行返回 dict，tuple 返回 tuple，stream 为无缓冲游标
+    cursors = {
+        'dict': aiomysql.DictCursor,
+        'tuple': aiomysql.Cursor,
+        'stream': aiomysql.SSDictCursor
+    }
+    # 估算表行数
+    table_rows_sql = (
+        'select TABLE_ROWS as _num from information_schema.TABLES '
+        'where TABLE_SCHEMA=database() and TABLE_NAME=?')
+
+    async def create_pools(self, loop, replicas=(), **kw):
+        """ 创建主库和从库连接池，返回 (主库, [从库]) """
+        primary = await self._create_pool(loop, **kw)
+        pools = []
+        for replica in replicas:
+            logger.info('create replica connection pool: {}'.format(
+                replica.get('host')))
+            pools.append(await self._create_pool(loop, **dict(kw, **replica)))
+        return primary, pools
+
+    async def _create_pool(self, loop, **kw):
+        """ 创建 aiomysql 连接池 """
+        return await aiomysql.create_pool(
+            host=kw.get('host', 'localhost'),
+            port=kw.get('port', 3306),
+            user=kw['user'],
+            password=kw['password'],
+            db=kw['db'],
+            charset=kw.get('charset', 'utf8'),
+            autocommit=kw.get('autocommit', True),
+            maxsize=kw.get('maxsize', 10),
+            minsize=kw.get('minsize', 1),
+            pool_recycle=kw.get('pool_recycle', 3600),
+            loop=loop
+        )
+
+    def translate_ddl(self, sql):
+        """ 转换建表语句，MySQL 无需转换 """
+        return sql
+
+    def upsert_sql(self, insert, primary_key, columns, increment=()):
+        """ 主键冲突时更新 columns、increment 中字段加一的插入语句，
+        insert 为模型的 __insert__ """
+        sets = ['`{0}`=VALUES(`{0}`)'.format(c) for c in columns]
+        sets.extend('`{0}`=`{0}`+1'.format(c) for c in increment)
+        if not sets:
+            # 冲突时保持原行不变
+            sets = ['`{0}`=`{0}`'.format(primary_key)]
+        return '{0} ON DUPLICATE KEY UPDATE {1}'.format(insert, ','.join(sets))
+
+    async def live_indexes(self, select, table):
+        """ 数据库中表的索引 {索引名: (unique, (字段,...))} """
+        rs = await select('SHOW INDEX FROM `{}`'.format(table), ())
+        indexes = {}
+        for r in sorted(rs, key=lambda r: (r['Key_name'], r['Seq_in_index'])):
+            if r['Key_name'] == 'PRIMARY':
+                continue
+            unique, columns = indexes.get(r['Key_name'], (not r['Non_unique'], ()))
+            indexes[r['Key_name']] = (unique, columns + (r['Column_name'],))
+        return indexes
+
+    explain_prefix = 'EXPLAIN'
+
+    def full_scans(self, plan):
+        """ 从 EXPLAIN 结果中找出全表扫描或无索引排序的部分 """
+        problems = []
+        for r in plan:
+            extra = r.get('Extra') or ''
+            if r.get('type') == 'ALL':
+                problems.append('full scan on {}'.format(r.get('table')))
+            if 'Using filesort' in extra:
+                problems.append('filesort on {}'.format(r.get('table')))
+        return problems
@@ -0,0 +1,316 @@
+# coding:utf-8
+""" SQLite 后端
+
+基于标准库 sqlite3，每个连接独占一个线程执行，接口与 aiomysql 一致。
+使用 WAL 模式：一个只有单个连接的写连接池作为主库，多个只读连接组成
+的连接池作为从库，读写互不阻塞。
+"""
+
+import re
+import asyncio
+import sqlite3
+import functools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from functions import logger
+
+
+class Cursor(object):
+    """ 游标，所有操作在连接所属线程中执行
+
+    支持 await conn.cursor() 和 async with conn.cursor() as cur 两种用法
+    """
+    def __init__(self, conn, as_dict=True):
+        self._conn = conn
+        self._as_dict = as_dict
+        self._cur = None
+        self._columns = None
+        self.rowcount = -1
+
+    def __await__(self):
+        return self._open().__await__()
+
+    async def __aenter__(self):
+        return await self._open()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def _open(self):
+        if self._cur is None:
+            self._cur = await self._conn._run(self._conn._db.cursor)
+        return self
+
+    async def execute(self, sql, args=None):
+        def run():
+            self._cur.execute(sql, args or ())
+            self._columns = self._column_names()
+            return self._cur.rowcount
+        self.rowcount = await self._conn._run(run)
+        return self.rowcount
+
+    async def executemany(self, sql, seq_args):
+        def run():
+            self._cur.executemany(sql, seq_args)
+            self._columns = None
+            return self._cur.rowcount
+        self.rowcount = await self._conn._run(run)
+        return self.rowcount
+
+    def _column_names(self):
+        description = self._cur.description
+        if description is None:
+            return None
+        return [d[0] for d in description]
+
+    def _convert(self, rows):
+        """ 在连接线程中转换行类型 """
+        if not self._as_dict or not self._columns:
+            return rows
+        columns = self._columns
+        return [dict(zip(columns, row)) for row in rows]
+
+    async def fetchall(self):
+        return await self._conn._run(
+            lambda: self._convert(self._cur.fetchall()))
+
+    async def fetchmany(self, size=None):
+        size = size or self._cur.arraysize
+        return await self._conn._run(
+            lambda: self._convert(self._cur.fetchmany(size)))
+
+    async def fetchone(self):
+        rows = await self._conn._run(
+            lambda: self._convert(self._cur.fetchmany(1)))
+        return rows[0] if rows else None
+
+    async def close(self):
+        if self._cur is not None and not self._conn.closed:
+            await self._conn._run(self._cur.close)
+        self._cur = None
+
+
+class Connection(object):
+    """ SQLite 连接，独占一个线程 """
+    def __init__(self, db, executor, loop, writer):
+        self._db = db
+        self._executor = executor
+        self._loop = loop
+        self._writer = writer
+        self._in_transaction = False
+        self.closed = False
+
+    @classmethod
+    async def connect(cls, path, loop, writer=False, timeout=5.0):
+        """ 打开连接，写连接设置 WAL 模式，读连接只读 """
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        def connect():
+            # isolation_level=None: 由 begin/commit 显式控制事务
+            db = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+            if writer:
+                db.execute('PRAGMA journal_mode=WAL')
+            else:
+                db.execute('PRAGMA query_only=ON')
+            db.execute('PRAGMA synchronous=NORMAL')
+            return db
+        db = await loop.run_in_executor(executor, connect)
+        return cls(db, executor, loop, writer)
+
+    def _run(self, fn, *args):
+        """ 在连接线程中执行 """
+        if self.closed:
+            raise sqlite3.ProgrammingError('Connection closed')
+        return self._loop.run_in_executor(
+            self._executor, functools.partial(fn, *args))
+
+    def cursor(self, cursor='dict'):
+        return Cursor(self, cursor == 'dict')
+
+    async def begin(self):
+        # 写连接立即获取写锁，避免事务中途升级锁失败
+        await self._run(
+            self._db.execute, 'BEGIN IMMEDIATE' if self._writer else 'BEGIN')
+        self._in_transaction = True
+
+    async def commit(self):
+        if self._in_transaction:
+            self._in_transaction = False
+            await self._run(self._db.execute, 'COMMIT')
+
+    async def rollback(self):
+        if self._in_transaction:
+            self._in_transaction = False
+            await self._run(self._db.execute, 'ROLLBACK')
+
+    async def ping(self, reconnect=True):
+        await self._run(self._db.execute, 'select 1')
+
+    @property
+    def in_transaction(self):
+        return self._in_transaction
+
+    def close(self):
+        """ 关闭连接 """
+        if self.closed:
+            return
+        self.closed = True
+        self._executor.submit(self._db.close)
+        self._executor.shutdown(wait=False)
+
+
+class Pool(object):
+    """ 连接池，接口与 aiomysql.Pool 一致 """
+    def __init__(self, factory, minsize=1, maxsize=10):
+        self._factory = factory
+        self._free = collections.deque()
+        self._used = set()
+        self._creating = 0
+        self._cond = asyncio.Condition()
+        self._closing = False
+        self.minsize = minsize
+        self.maxsize = maxsize
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used) + self._creating
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def fill(self):
+        """ 建立 minsize 个连接 """
+        while self.size < self.minsize:
+            self._creating += 1
+            try:
+                conn = await self._factory()
+            finally:
+                self._creating -= 1
+            self._free.append(conn)
+
+    async def acquire(self):
+        """ 获取连接，无空闲连接且达到 maxsize 时等待 """
+        async with self._cond:
+            while True:
+                while self._free:
+                    conn = self._free.popleft()
+                    if not conn.closed:
+                        self._used.add(conn)
+                        return conn
+                if self.size < self.maxsize:
+                    self._creating += 1
+                    try:
+                        conn = await self._factory()
+                    finally:
+                        self._creating -= 1
+                    self._used.add(conn)
+                    return conn
+                await self._cond.wait()
+
+    def release(self, conn):
+        """ 归还连接，返回 future """
+        self._used.discard(conn)
+        if not conn.closed:
+            if conn.in_transaction or self._closing:
+                # 未结束的事务不能交给下一个使用者
+                conn.close()
+            else:
+                self._free.append(conn)
+        return asyncio.ensure_future(self._wakeup())
+
+    async def _wakeup(self):
+        async with self._cond:
+            self._cond.notify()
+
+    def close(self):
+        self._closing = True
+        while self._free:
+            self._free.popleft().close()
+
+    async def wait_closed(self):
+        for conn in list(self._used):
+            conn.close()
+
+
+# MySQL 建表语句中 SQLite 不支持的部分
+_DDL_REMOVE = [
+    re.compile(r'/\*.*?\*/', re.S),
+    re.compile(r'^\s*--.*$', re.M),
+    re.compile(r'^\s*SET\s+[^;]*;', re.M | re.I),
+    re.compile(r'\s+CHARACTER\s+SET\s+\w+', re.I),
+    re.compile(r'\s+COLLATE\s+\w+', re.I),
+    re.compile(r'\s+USING\s+BTREE', re.I),
+]
+_DDL_TABLE_OPTIONS = re.compile(r'\)\s*ENGINE\s*=[^;]*;', re.I)
+
+
+class SQLiteBackend(object):
+    """ SQLite 后端 """
+    name = 'sqlite'
+    placeholder = '?'
+    cursors = {'dict': 'dict', 'tuple': 'tuple', 'stream': 'dict'}
+    table_rows_sql = None  # 不支持估算行数，使用 count(*)
+
+    async def create_pools(self, loop, replicas=(), **kw):
+        """ 创建写连接池(单连接)和只读连接池，返回 (写, [读])
+
+        :param path-数据库文件路径，未指定时使用 db 配置
+        :param readers-只读连接数
+        """
+        path = kw.get('path') or kw['db']
+        timeout = kw.get('timeout', 5.0)
+        logger.info('open sqlite database: {}'.format(path))
+        writer = Pool(
+            lambda: Connection.connect(path, loop, True, timeout), 1, 1)
+        # 先打开写连接，确保数据库文件和 WAL 模式就绪
+        await writer.fill()
+        readers = Pool(
+            lambda: Connection.connect(path, loop, False, timeout),
+            min(kw.get('minsize', 1), kw.get('readers', 4)),
+            kw.get('readers', 4))
+        await readers.fill()
+        return writer, [readers]
+
+    def translate_ddl(self, sql):
+        """ 将 MySQL 建表语句(如 db/table.sql)转换为 SQLite 可执行的语句 """
+        for pattern in _DDL_REMOVE:
+            sql = pattern.sub('', sql)
+        return _DDL_TABLE_OPTIONS.sub(');', sql)
+
+    def upsert_sql(self, insert, primary_key, columns, increment=()):
+        """ 主键冲突时更新 columns、increment 中字段加一的插入语句，
+        insert 为模型的 __insert__
+
+        需要 SQLite 3.24 以上
+        """
+        sets = ['`{0}`=excluded.`{0}`'.format(c) for c in columns]
+        sets.extend('`{0}`=`{0}`+1'.format(c) for c in increment)
+        if not sets:
+            return '{0} ON CONFLICT(`{1}`) DO NOTHING'.format(insert, primary_key)
+        return '{0} ON CONFLICT(`{1}`) DO UPDATE SET {2}'.format(
+            insert, primary_key, ','.join(sets))
+
+    async def live_indexes(self, select, table):
+        """ 数据库中表的索引 {索引名: (unique, (字段,...))} """
+        indexes = {}
+        for r in await select("PRAGMA index_list(`{}`)".format(table), ()):
+            if r['origin'] == 'pk':
+                continue
+            info = await select("PRAGMA index_info(`{}`)".format(r['name']), ())
+            indexes[r['name']] = (bool(r['unique']), tuple(
+                i['name'] for i in sorted(info, key=lambda i: i['seqno'])))
+        return indexes
+
+    explain_prefix = 'EXPLAIN QUERY PLAN'
+
+    def full_scans(self, plan):
+        """ 从 EXPLAIN QUERY PLAN 结果中找出全表扫描或临时排序的部分 """
+        problems = []
+        for r in plan:
+            detail = r.get('detail') or ''
+            if detail.startswith('SCAN') and 'INDEX' not in detail:
+                problems.append(detail)
+            if 'TEMP B-TREE' in detail:
+                problems.append(detail)
+        return problems
@@ -0,0 +1,48 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+""" 静态文件和 JSON 响应的压缩率与压缩耗时，对比各压缩级别
+
+在 www 目录下运行: python -m benchmark.compression
+"""
+import os
+import json
+import time
+import compress
+
+ROUNDS = 50
+STATIC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static')
+
+
+def samples():
+    """ 静态文件和一页 /api/blogs 的 JSON """
+    for name in ('js/awesome.js', 'js/webapp.js', 'css/markdown.css'):
+        with open(os.path.join(STATIC, name), 'rb') as f:
+            yield name, f.read()
+    blogs = [dict(id='%050d' % i, name='blog %d' % i, summary='summary ' * 20,
+                  user_name='user', created_at=time.time() - i * 3600)
+             for i in range(10)]
+    yield '/api/blogs', json.dumps(dict(blogs=blogs)).encode('utf-8')
+
+
+def measure(body, encoding, level):
+    """ (压缩后字节数, 每次压缩耗时微秒) """
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        data = compress.compress(body, encoding, level)
+    return len(data), (time.perf_counter() - start) / ROUNDS * 1e6
+
+
+def main():
+    levels = [('gzip', 1), ('gzip', 5), ('gzip', 9)]
+    if compress.brotli is not None:
+        levels += [('br', 4), ('br', 11)]
+    for name, body in samples():
+        print('{0} ({1} bytes)'.format(name, len(body)))
+        for encoding, level in levels:
+            size, cost = measure(body, encoding, level)
+            print('  {0:<4} {1:>2}  {2:>7} bytes {3:>5.1f}%  {4:>9.1f} us'.format(
+                encoding, level, size, size * 100.0 / len(body), cost))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+""" RequestHandler 参数整理开销对比：预编译参数绑定与原实现
+
+在 www 目录下运行: python -m benchmark.dispatch
+"""
+import time
+import asyncio
+from urllib import parse
+from multidict import MultiDict
+from aiohttp import web
+from webFrame import RequestHandler, get, post
+from apis import APIError
+from functions import logger
+
+ROUNDS = 20000
+
+
+class LegacyRequestHandler(RequestHandler):
+    """ 原 RequestHandler.__call__，每个请求重新判断参数来源 """
+
+    async def __call__(self, request):
+        kw = None
+        if (self._has_var_kw_arg or
+                self._has_named_kw_args or
+                self._required_kw_args):
+            if request.method == 'POST':
+                if not request.content_type:
+                    return web.HTTPBadRequest(reason='Missing Content-type')
+                ct = request.content_type.lower()
+                if ct.startswith('application/json'):
+                    params = await request.json()
+                    if not isinstance(params, dict):
+                        return web.HTTPBadRequest(
+                            reason='Json body must be object')
+                    kw = params
+                elif (ct.startswith('application/x-www-form-urlencoded') or
+                        ct.startswith('multipart/form-data')):
+                    params = await request.post()
+                    kw = dict(**params)
+                else:
+                    return web.HTTPBadRequest(
+                        reason='Unsupported Content-Type: {0}'
+                        ''.format(request.content_type),
+                        content_type=request.content_type
+                        )
+            if request.method == 'GET':
+                qs = request.query_string
+                if qs:
+                    kw = {}
+                    for k, v in parse.parse_qs(qs, True).items():
+                        kw[k] = v[0]
+        if kw is None:
+            kw = dict(**request.match_info)
+        else:
+            if (not self._has_var_kw_arg) and self._named_kw_args:
+                copy = {}
+                for name in self._named_kw_args:
+                    if name in kw:
+                        copy[name] = kw[name]
+                kw = copy
+            for k, v in request.match_info.items():
+                if k in kw:
+                    logger.warning(
+                        'Duplicate arg name in named '
+                        'arg and kw args{0}'.format(k)
+                        )
+                kw[k] = v
+        if self._has_request_arg:
+            kw['request'] = request
+        if self._required_kw_args:
+            for name in self._required_kw_args:
+                if not (name in kw):
+                    return web.HTTPBadRequest(
+                        reason='Missing argument:{0}'.format(name))
+        if not kw:
+            stream_data = await request.read()
+            if stream_data:
+                logger.info("stream request: {}".format(stream_data.decode('utf-8')))
+                kw['data'] = stream_data.decode('utf-8')
+        logger.info('call with args:{0}'.format(str(kw)))
+        try:
+            r = await self._func(**kw)
+            return r
+        except APIError as e:
+            return dict(error=e.error, data=e.data, message=e.message)
+
+
+class FakeRequest(object):
+    """ 只实现 RequestHandler 用到的属性 """
+    def __init__(self, method, query_string='', match_info=None, json=None):
+        self.method = method
+        self.query_string = query_string
+        self.match_info = match_info or {}
+        self.content_type = 'application/json' if json is not None else ''
+        self._json = json
+
+    async def json(self):
+        return self._json
+
+    async def post(self):
+        return MultiDict()
+
+    async def read(self):
+        return b''
+
+
+@get('/api/blogs')
+async def api_blogs(*, page=1, after=None, fields=None):
+    return page
+
+
+@get('/blog/{id}')
+async def get_blog(id):
+    return id
+
+
+@get('/register')
+async def register():
+    return 'register'
+
+
+@post('/api/users')
+async def api_register_user(*, email, name, passwd):
+    return email
+
+
+CASES = [
+    ('GET query', api_blogs,
+     FakeRequest('GET', 'page=2&fields=name,summary&utm_source=feed')),
+    ('GET match_info', get_blog,
+     FakeRequest('GET', match_info={'id': '0015'})),
+    ('GET no args', register, FakeRequest('GET')),
+    ('POST json', api_register_user,
+     FakeRequest('POST', json={'email': 'a@b.c', 'name': 'n', 'passwd': 'x' * 40})),
+]
+
+
+async def measure(handler, request):
+    """ 每次调用的平均耗时(微秒) """
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        await handler(request)
+    return (time.perf_counter() - start) / ROUNDS * 1e6
+
+
+async def run():
+    for label, fn, request in CASES:
+        legacy = await measure(LegacyRequestHandler(None, fn), request)
+        binder = await measure(RequestHandler(None, fn), request)
+        print('{0:<16} legacy {1:>7.2f} us   binder {2:>7.2f} us   {3:>5.2f}x'.format(
+            label, legacy, binder, legacy / binder))
+
+
+def main():
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
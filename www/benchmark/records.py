@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+""" 只读记录与 Model 构造开销对比
+
+在 www 目录下运行: python -m benchmark.records
+"""
+import time
+import tracemalloc
+from models import Blog
+from orm import TextField, IntegerField, FloatField
+
+ROWS = 10000
+
+
+def sample_value(name, i):
+    """ 按字段类型生成模拟值 """
+    field = Blog.__mappings__[name]
+    if name == Blog.__primary_key__:
+        return '{:064d}'.format(i)
+    if isinstance(field, TextField):
+        return '{} '.format(name) * 50
+    if isinstance(field, IntegerField):
+        return i
+    if isinstance(field, FloatField):
+        return time.time()
+    return '{0} {1}'.format(name, i)
+
+
+def make_rows():
+    """ 模拟游标返回的行，tuple 行和 DictCursor 的 dict 行 """
+    names = (Blog.__primary_key__,) + tuple(Blog.__fields__)
+    tuples = [tuple(sample_value(n, i) for n in names) for i in range(ROWS)]
+    dicts = [dict(zip(names, t)) for t in tuples]
+    return tuples, dicts
+
+
+def measure(label, build, rows):
+    """ 统计构造耗时和内存分配 """
+    tracemalloc.start()
+    start = time.perf_counter()
+    objs = build(rows)
+    elapsed = time.perf_counter() - start
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{0:<16} {1:>8.2f} ms  {2:>10.1f} KiB  ({3} rows)'.format(
+        label, elapsed * 1000, peak / 1024, len(objs)))
+    return elapsed, peak
+
+
+def main():
+    tuples, dicts = make_rows()
+    # DictCursor 每行一个 dict，cls(**r) 再复制一次
+    model_cost = measure(
+        'Model', lambda rs: [Blog(**dict(r)) for r in rs], dicts)
+    record = Blog.__record__
+    record_cost = measure(
+        'Blog.__record__', lambda rs: [record(r) for r in rs], tuples)
+    print('time x{0:.1f}, memory x{1:.1f}'.format(
+        model_cost[0] / record_cost[0], model_cost[1] / record_cost[1]))
+
+
+if __name__ == '__main__':
+    main()
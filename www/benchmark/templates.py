@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+""" 模板冷启动与单次渲染开销对比：开发模式与生产模式(预编译 + 字节码缓存)
+
+在 www 目录下运行: python -m benchmark.templates
+"""
+import os
+import time
+import shutil
+import tempfile
+from app import init_jinja2, datetime_filter
+from apis import Page
+from webFrame import StaticFiles
+
+ROUNDS = 2000
+FILTERS = dict(datetime=datetime_filter)
+GLOBALS = dict(asset_url=StaticFiles(os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static')).url)
+
+
+def cold_start(**kw):
+    """ 新建模板环境并编译全部模板的耗时(毫秒) """
+    start = time.perf_counter()
+    env = init_jinja2({}, filters=FILTERS, globals=GLOBALS, **kw)
+    for name in env.list_templates():
+        env.get_template(name)
+    return (time.perf_counter() - start) * 1000
+
+
+def render_cost(env):
+    """ 按 response_factory 的方式获取并渲染 blogs.html 的平均耗时(微秒) """
+    blogs = [
+        dict(id='%050d' % i, name='blog %d' % i, summary='summary ' * 10,
+             created_at=time.time() - i * 3600)
+        for i in range(10)
+    ]
+    context = dict(blogs=blogs, page=Page(100, 1), __user__=None)
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        env.get_template('blogs.html').render(**context).encode('utf-8')
+    return (time.perf_counter() - start) / ROUNDS * 1e6
+
+
+def main():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        print('cold start')
+        print('  {0:<28} {1:>8.1f} ms'.format(
+            'compile from source', cold_start()))
+        cold_start(production=True, bytecode_cache=cache_dir)
+        print('  {0:<28} {1:>8.1f} ms'.format(
+            'warm bytecode cache', cold_start(
+                production=True, bytecode_cache=cache_dir)))
+
+        print('render blogs.html')
+        dev = init_jinja2({}, filters=FILTERS, globals=GLOBALS)
+        prod = init_jinja2({}, filters=FILTERS, globals=GLOBALS,
+                           production=True, bytecode_cache=cache_dir)
+        print('  {0:<28} {1:>8.1f} us'.format('auto_reload', render_cost(dev)))
+        print('  {0:<28} {1:>8.1f} us'.format('production', render_cost(prod)))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+""" 响应压缩
+
+按 Accept-Encoding 协商 gzip 或 brotli(安装了 brotli 时)。动态响应的压缩级别
+有上限，避免高级别压缩占用过多 CPU；静态文件在启动时以最高级别压缩一次。
+"""
+
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    # 未安装 brotli 时只使用 gzip
+    brotli = None
+
+# 动态响应的压缩级别上限
+GZIP_LEVEL_CAP = 6
+BROTLI_QUALITY_CAP = 5
+
+# 可压缩的内容类型，图片等已压缩的格式不再压缩
+COMPRESSIBLE = ('text/', 'application/json', 'application/javascript',
+                'application/xml', 'image/svg+xml')
+
+
+def encodings():
+    """ 服务端支持的编码，按优先顺序 """
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate(header, available=None):
+    """ 按 Accept-Encoding 选择编码，不接受任何压缩编码时返回 None
+
+    q 值高者优先，相同时按 available 的顺序
+    """
+    if not header:
+        return None
+    if available is None:
+        available = encodings()
+    accepted = {}
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for name in available:
+        q = accepted.get(name, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def compressible(content_type):
+    return bool(content_type) and content_type.startswith(COMPRESSIBLE)
+
+
+def compress(body, encoding, level):
+    """ 压缩 body，level 为 gzip 级别或 brotli quality """
+    if encoding == 'br':
+        return brotli.compress(body, quality=level)
+    # mtime 固定为 0，同样的内容压缩结果相同
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+class Compressor(object):
+    """ 动态响应压缩
+
+    :param min_size-小于该字节数的响应不压缩
+    :param gzip_level-gzip 级别，不超过 GZIP_LEVEL_CAP
+    :param brotli_quality-brotli quality，不超过 BROTLI_QUALITY_CAP
+    """
+
+    def __init__(self, min_size=1024, gzip_level=5, brotli_quality=4):
+        self.min_size = min_size
+        self.levels = {
+            'gzip': min(gzip_level, GZIP_LEVEL_CAP),
+            'br': min(brotli_quality, BROTLI_QUALITY_CAP)
+        }
+
+    def compress(self, body, encoding):
+        """ 压缩后没有变小时返回 None """
+        if len(body) < self.min_size:
+            return None
+        data = compress(body, encoding, self.levels[encoding])
+        return data if len(data) < len(body) else None
@@ -6,11 +6,68 @@ CONF = {
     'host': '127.0.0.1',
     'port': 80,
     'db': {
+        # 数据库后端 mysql 或 sqlite
+        # sqlite 使用 path 指定数据库文件，readers 为只读连接数，
+        # create_tables 为真时启动时按模型建表
+        'backend': 'mysql',
+        # 'path': '/srv/web/db/webapp.db',
+        # 'readers': 4,
+        # 'create_tables': True,
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'test',
         'password': '****',
-        'dbName': 'test'
+        'dbName': 'test',
+        # 只读从库，未配置的项使用主库配置
+        # 'replicas': [{'host': '127.0.0.2'}, {'host': '127.0.0.3'}],
+        'replicas': [],
+        'read_policy': 'round_robin',  # round_robin 或 least_busy
+        'read_your_writes': 5,  # 写入后多少秒内的读请求走主库
+        # 记录实际执行的查询，由 /api/schema/explain 检查执行计划
+        'track_queries': False,
+        'count_interval': 60,  # 缓存的表行数校准间隔(秒)
+        'minsize': 5,  # 启动时预先建立的连接数
+        'maxsize': 10,
+        'acquire_timeout': 3,  # 获取连接超时(秒)，超时返回503
+        'pool_recycle': 3600,  # 连接最长使用时间(秒)
+        'ping_interval': 30  # 空闲连接保活检测间隔(秒)
+    },
+    'cache': {
+        'max_entries': 1024  # 内存响应缓存最多保存的响应数
+    },
+    'compression': {
+        # 按 Accept-Encoding 压缩文本响应(gzip，安装 brotli 后支持 br)
+        'enabled': True,
+        'min_size': 1024,  # 小于该字节数的响应不压缩
+        'gzip_level': 5,  # 动态响应压缩级别，上限为 compress.GZIP_LEVEL_CAP
+        'brotli_quality': 4  # 上限为 compress.BROTLI_QUALITY_CAP
+    },
+    'limits': {
+        # 每个路由的并发限制，超出的请求排队，队列满或排队超时返回503
+        'default': {
+            'limit': 20,  # 初始并发数
+            'queue': 50,  # 排队长度
+            'queue_timeout': 3,  # 排队超时(秒)
+            'adaptive': True,  # 按延迟调整并发数
+            'target_latency': 0.5,  # 平均延迟超过该值(秒)时减小并发数
+            'min_limit': 2,
+            'max_limit': 100
+        },
+        # 路由单独配置，rate/burst 为按客户端的令牌桶限流(每秒令牌数/容量)，超出返回429
+        'routes': {
+            '/api/authenticate': {'rate': 0.5, 'burst': 5, 'limit': 5},
+            '/api/users': {'rate': 0.1, 'burst': 3, 'limit': 5}
+        },
+        'exempt': ['/static', '/metrics']  # 不限制的路由前缀
+    },
+    'templates': {
+        # 生产模式：启动时预编译全部模板，不再检查模板文件修改
+        'production': False,
+        # 模板字节码缓存目录，None 不使用
+        'bytecode_cache': None  # '/srv/web/cache/templates'
+    },
+    'metrics': {
+        'allow': ['127.0.0.1', '::1']  # 允许访问 /metrics 的地址
     },
     'session': {
         'secret': 'cowpea'
@@ -0,0 +1,4 @@
+-- 已有数据库升级：blogs 增加版本号和修改时间，用于 ETag/Last-Modified
+ALTER TABLE `blogs` ADD COLUMN `version` bigint NOT NULL DEFAULT 0;
+ALTER TABLE `blogs` ADD COLUMN `updated_at` double(20, 10) NULL DEFAULT NULL;
+UPDATE `blogs` SET `updated_at` = `created_at` WHERE `updated_at` IS NULL;
@@ -1,4 +1,5 @@
-vicat Premium Data Transfer
+/*
+ Navicat Premium Data Transfer
 
  Source Server         : 主机MariaDB
  Source Server Type    : MariaDB
@@ -27,6 +28,8 @@ CREATE TABLE `blogs`  (
   `summary` varchar(100) CHARACTER SET utf8 COLLATE utf8_general_ci NULL DEFAULT NULL,
   `content` text CHARACTER SET utf8 COLLATE utf8_general_ci NULL,
   `created_at` double(20, 10) NULL DEFAULT NULL,
+  `version` bigint NOT NULL DEFAULT 0,
+  `updated_at` double(20, 10) NULL DEFAULT NULL,
   PRIMARY KEY (`id`) USING BTREE
 ) ENGINE = InnoDB CHARACTER SET = utf8 COLLATE = utf8_general_ci ROW_FORMAT = Compact;
 
@@ -58,5 +61,11 @@ CREATE TABLE `users`  (
   PRIMARY KEY (`id`) USING BTREE
 ) ENGINE = InnoDB CHARACTER SET = utf8 COLLATE = utf8_general_ci ROW_FORMAT = Compact;
 
+-- ----------------------------
+-- Indexes, 与 models.py 中的声明一致
+-- ----------------------------
+CREATE INDEX `idx_blogs_created_at_id` ON `blogs` (`created_at`, `id`);
+CREATE UNIQUE INDEX `uq_users_email` ON `users` (`email`);
+
 SET FOREIGN_KEY_CHECKS = 1;
 
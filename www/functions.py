@@ -5,14 +5,80 @@
 import re
 import hashlib
 import time
+import queue
+import atexit
+import random
+import configparser
 import logging.config
+import logging.handlers
 from apis import APIPermissionError
 import sys
 import traceback
 
+_LOG_CONF = './config/log.conf'
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """ 日志写入队列，由后台线程格式化和写入
+
+    标准 QueueHandler 在调用线程中按格式化器生成整行，这里只合并消息和参数
+    (级别和采样过滤之后才执行)，时间、格式等留给后台线程。参数可能是事件循环
+    中会被修改的对象(SQL 参数列表、Model)，必须在入队前转成字符串
+    """
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # 异常堆栈必须在当前线程中格式化
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class SampleFilter(logging.Filter):
+    """ 按比例采样 WARNING 以下的日志 """
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return (record.levelno >= logging.WARNING or
+                self.rate >= 1 or random.random() < self.rate)
+
+
+def setup_logging(path=_LOG_CONF):
+    """ 加载日志配置，root 的处理器移到后台线程
+
+    [sampling] 段配置各分类日志的采样比例，如 sql = 0.1
+    """
+    logging.config.fileConfig(path)
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    q = queue.SimpleQueue()
+    for h in handlers:
+        root.removeHandler(h)
+    root.addHandler(LazyQueueHandler(q))
+    listener = logging.handlers.QueueListener(
+        q, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    parser = configparser.ConfigParser()
+    parser.read(path)
+    if parser.has_section('sampling'):
+        for name, rate in parser.items('sampling'):
+            logging.getLogger(name).addFilter(SampleFilter(float(rate)))
+    return listener
+
+
 # 日志配置
-logging.config.fileConfig('./config/log.conf')
+_log_listener = setup_logging()
 logger = logging.getLogger('root')
+sql_logger = logging.getLogger('sql')  # orm 执行的语句
+access_logger = logging.getLogger('access')  # 请求日志
+wechat_logger = logging.getLogger('wechat')  # 微信消息
 # 调试未捕获异常用 logger.basicConfig(level=logger.INFO)
 
 # variable
@@ -36,6 +102,58 @@ def get_page_index(page):
     return int(page) if int(page) > 0 else 1
 
 
+def make_etag(*parts):
+    """ 由版本信息生成强 ETag """
+    return '"{}"'.format(hashlib.sha1(repr(parts).encode('utf-8')).hexdigest())
+
+
+# 压缩响应的 ETag 后缀，如 "abc-gzip"
+_ETAG_ENCODINGS = ('-gzip"', '-br"')
+
+
+def encoded_etag(etag, encoding):
+    """ 压缩后响应的 ETag，不同编码的响应内容不同，ETag 也要不同 """
+    if not etag.endswith('"'):
+        return etag
+    return '{0}-{1}"'.format(etag[:-1], encoding)
+
+
+def _strip_encoding(etag):
+    if etag.endswith(_ETAG_ENCODINGS):
+        return etag[:etag.rindex('-')] + '"'
+    return etag
+
+
+def etag_matches(header, etag):
+    """ 比较 If-None-Match 与 ETag，忽略弱校验前缀 W/ 和压缩编码后缀 """
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or _strip_encoding(tag) == _strip_encoding(etag):
+            return True
+    return False
+
+
+def not_modified(request, etag, last_modified=None):
+    """ 设置响应的 ETag/Last-Modified，客户端缓存仍然有效时返回 True
+
+    有 If-None-Match 时不再比较 If-Modified-Since；ETag 包含静态文件版本，
+    重新部署静态文件后页面中带哈希的地址会变化，客户端不能继续使用旧页面
+    """
+    version = request.app.get('__asset_version__')
+    if version:
+        etag = '{0}.{1}"'.format(etag[:-1], version)
+    request.__validators__ = (etag, last_modified)
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    since = request.if_modified_since
+    if since is not None and last_modified is not None:
+        return int(last_modified) <= since.timestamp()
+    return False
+
+
 def user2cookie(user, max_age):
     """ 加密生成cookie """
     expires = str(int(time.time()) + max_age)
@@ -47,6 +165,7 @@ def user2cookie(user, max_age):
 async def cookie2user(cookie_str):
     """ 从cookie解析用户数据 """
 
+    import orm
     import models
     if not cookie_str:
         return None
@@ -57,14 +176,18 @@ async def cookie2user(cookie_str):
         uid, expires, sha1 = L
         if int(expires) < time.time():
             return None
-        user = await models.User.find(uid)
+        # 在该用户的会话中查询，刚注册或修改过的用户从主库读取
+        with orm.session_scope(uid):
+            user = await models.User.find(uid)
         if user is None:
             return None
         s = "{}-{}-{}-{}".format(uid, user.passwd, expires, _COOKIE_KEY)
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             print(L)
-            logger.error('invalid sha1, uid:{0}'.format(uid))
+            logger.error('invalid sha1, uid:%s', uid)
             return None
+        # 复制后再隐藏密码，避免修改请求对象缓存中的对象
+        user = models.User(**user)
         user.passwd = '****'
         return user
     except Exception as e:
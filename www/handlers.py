@@ -7,19 +7,25 @@ import json
 # import asyncio
 import hashlib
 import mistune
+import orm
+import schema
+import metrics
 
 # from mistune_contrib.toc import TocMixin
 from aiohttp import web
-from webFrame import get, post
+from webFrame import get, post, cached, invalidate, response_cache
 from models import User, Comment, Blog, next_id
-from apis import Page, APIError, APIValueError
+from apis import (
+    Page, CursorPage, APIError, APIValueError, decode_cursor, _PAGE_SIZE
+)
 import functions as Glo
-from functions import logger
+from functions import wechat_logger
 from config.env import CONF
 from wechat.handle import MsgHandle
 
 
 @get('/')
+@cached(ttl=300, tags=['users'])
 async def index(request):
     """ 首页 """
     users = await User.findAll()
@@ -50,7 +56,10 @@ async def api_register_user(*, email, name, passwd):
         passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(),
         image=Glo.get_avatar(hashlib.md5(email.encode('utf-8')).hexdigest())
     )
-    await user.save()
+    # 记录为新用户会话的写入，下一个请求 cookie2user 从主库读取该用户
+    with orm.session_scope(uid):
+        await user.save()
+    invalidate('users')
     # make session cookie
     r = web.Response()
     r.set_cookie(
@@ -120,19 +129,88 @@ def signout(request):
     return r
 
 
+_BLOG_SEEK = ('created_at', 'id')  # 文章列表键集分页字段
+
+
+def _blog_fields(fields):
+    """ 解析 fields 参数，如 fields=name,summary """
+    if not fields:
+        return None
+    names = [f.strip() for f in fields.split(',') if f.strip()]
+    for name in names:
+        if name not in Blog.__mappings__:
+            raise APIValueError('fields', 'Invalid field: {}'.format(name))
+    return names
+
+
+async def _blogs_after(after, **kw):
+    """ 键集分页查询文章，after 为空串时从第一页开始 """
+    blogs = await Blog.findAll(
+        seek=_BLOG_SEEK,
+        after=decode_cursor(after, len(_BLOG_SEEK)) if after else None,
+        limit=_PAGE_SIZE + 1,
+        **kw
+    )
+    return CursorPage(blogs, _BLOG_SEEK, after), blogs
+
+
+async def _blogs_page(page, **kw):
+    """ 按页码查询文章 """
+    if page.item_count == 0:
+        return []
+    return await Blog.findAll(
+        orderBy='created_at desc',
+        limit=(page.offset, page.limit),
+        **kw
+    )
+
+
+_BLOG_VERSION = ['version', 'updated_at']  # 生成 ETag 只需查询的字段
+
+
+def _user_id(request):
+    return request.__user__.id if request.__user__ else None
+
+
+def _not_modified():
+    return web.Response(status=304)
+
+
+def _list_not_modified(request, blogs, *extra):
+    """ 列表的 ETag 由查询参数和当前页文章的 id、版本号生成
+
+    列表不发送 Last-Modified：删除文章后较早的文章移入当前页，
+    最大修改时间不变，只按 If-Modified-Since 判断会返回过期的列表
+    """
+    etag = Glo.make_etag(
+        request.path_qs, extra, [(b.id, b.version) for b in blogs])
+    return Glo.not_modified(request, etag)
+
+
 @get('/blogs')
-async def blogs(*, page=1):
-    """ 文章列表 """
+@cached(ttl=300, tags=['blogs'])
+async def blogs(request, *, page=1, after=None):
+    """ 文章列表，页面未修改时只查询当前页文章的版本号 """
+    user_id = _user_id(request)
+    if after is not None:
+        page, keys = await _blogs_after(
+            after, only=_BLOG_VERSION, record=True)
+        if _list_not_modified(request, keys, user_id):
+            return _not_modified()
+        page, blogs = await _blogs_after(
+            after, defer=['content'], record=True)
+        return {
+            '__template__': 'blogs.html',
+            'page': page,
+            'blogs': blogs
+        }
     page_index = Glo.get_page_index(page)
-    num = await Blog.findNumber('count(id)')
+    num = await Blog.count()
     page = Page(num, page_index)
-    if num == 0:
-        blogs = []
-    else:
-        blogs = await Blog.findAll(
-            orderBy='created_at desc',
-            limit=(page.offset, page.limit)
-        )
+    keys = await _blogs_page(page, only=_BLOG_VERSION, record=True)
+    if _list_not_modified(request, keys, num, user_id):
+        return _not_modified()
+    blogs = await _blogs_page(page, defer=['content'], record=True)
     return {
         '__template__': 'blogs.html',
         'page': page,
@@ -141,8 +219,14 @@ async def blogs(*, page=1):
 
 
 @get('/blog/{id}')
-async def get_blog(id):
-    """ 文章详情 """
+@cached(ttl=300, tags=['blogs'])
+async def get_blog(id, request):
+    """ 文章详情，未修改时在查询正文和 markdown 转换前返回 304 """
+    rs = await Blog.findAll('`id`=?', [id], only=_BLOG_VERSION, record=True)
+    if rs and Glo.not_modified(
+            request, Glo.make_etag('blog', id, rs[0].version, _user_id(request)),
+            rs[0].updated_at):
+        return _not_modified()
     blog = await Blog.find(id)
     comments = await Comment.findAll('id=?', [id], orderBy='created_at desc')
     for c in comments:
@@ -173,12 +257,18 @@ async def api_create_blog(request, *, name, summary, content):
         content=content.strip()
     )
     await blog.save()
+    invalidate('blogs')
     return blog
 
 
 @get('/api/blog/{id}')
-async def api_get_blog(*, id):
+async def api_get_blog(request, *, id):
     """ 文章详情 api """
+    rs = await Blog.findAll('`id`=?', [id], only=_BLOG_VERSION, record=True)
+    if rs and Glo.not_modified(
+            request, Glo.make_etag('api_blog', id, rs[0].version),
+            rs[0].updated_at):
+        return _not_modified()
     blog = await Blog.find(id)
     return blog
 
@@ -198,6 +288,7 @@ async def api_update_blog(id, request, *, name, summary, content):
     blog.summary = summary.strip()
     blog.content = content.strip()
     await blog.update()
+    invalidate('blogs')
     return blog
 
 
@@ -207,21 +298,28 @@ async def api_delete_blog(request, *, id):
     Glo.check_admin(request)
     blog = await Blog.find(id)
     await blog.remove()
+    invalidate('blogs')
     return dict(id=id)
 
 
 @get('/api/blogs')
-async def api_blogs(*, page=1):
-    """ 文章列表 api """
+@cached(ttl=300, tags=['blogs'])
+async def api_blogs(request, *, page=1, after=None, fields=None):
+    """ 文章列表 api, 传入 after 游标时使用键集分页, fields 指定返回字段 """
+    only = _blog_fields(fields)
+    if after is not None:
+        p, keys = await _blogs_after(after, only=_BLOG_VERSION, record=True)
+        if _list_not_modified(request, keys):
+            return _not_modified()
+        p, blogs = await _blogs_after(after, only=only, record=True)
+        return dict(page=p, blogs=blogs)
     page_index = Glo.get_page_index(page)
-    num = await Blog.findNumber('count(id)')
+    num = await Blog.count()
     p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, blogs=())
-    blogs = await Blog.findAll(
-        orderBy='created_at desc',
-        limit=(p.offset, p.limit)
-    )
+    keys = await _blogs_page(p, only=_BLOG_VERSION, record=True)
+    if _list_not_modified(request, keys, num):
+        return _not_modified()
+    blogs = await _blogs_page(p, only=only, record=True)
     return dict(page=p, blogs=blogs)
 
 
@@ -260,10 +358,48 @@ async def manage_blogs(*, page=1):
     }
 
 
+@get('/manage/stats')
+async def manage_stats():
+    """ 数据库连接池统计 """
+    return {
+        '__template__': 'manage_stats.html',
+        'pools': orm.pool_stats(),
+        'response_cache': response_cache.stats(),
+        'sql_cache': orm.sql_cache_info()
+    }
+
+
+@get('/api/stats')
+async def api_stats(request):
+    """ 数据库连接池统计 api """
+    Glo.check_admin(request)
+    return dict(pools=orm.pool_stats(), sql_cache=orm.sql_cache_info(),
+                response_cache=response_cache.stats())
+
+
+@get('/api/schema/explain')
+async def api_schema_explain(request):
+    """ 检查运行中记录的查询(db.track_queries)的执行计划 """
+    Glo.check_admin(request)
+    queries = orm.tracked_queries()
+    return dict(queries=queries, problems=await schema.explain(queries))
+
+
+@get('/metrics')
+async def api_metrics(request):
+    """ 运行指标，Prometheus 文本格式，只允许配置的地址抓取 """
+    allow = CONF.get('metrics', {}).get('allow', ('127.0.0.1', '::1'))
+    if request.remote not in allow:
+        return web.HTTPForbidden()
+    resp = web.Response(body=metrics.REGISTRY.render().encode('utf-8'))
+    resp.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return resp
+
+
 @get('/wechat/wx')
 async def wx(**data):
     """ 微信验证 """
-    logger.warning("datawx=%s " % data)
+    wechat_logger.info("datawx=%s ", data)
     try:
         if len(data) == 0:
             return "hello, this is handle view"
@@ -280,8 +416,8 @@ async def wx(**data):
         sha1 = hashlib.sha1()
         sha1.update(list_temp.encode('utf-8'))
         hashcode = sha1.hexdigest()
-        logger.info(
-            f"wechat signature: hashcode:{hashcode}, signature:{signature} "
+        wechat_logger.info(
+            "wechat signature: hashcode:%s, signature:%s ", hashcode, signature
         )
         if hashcode == signature:
             return echostr
@@ -294,11 +430,11 @@ async def wx(**data):
 @post('/wechat/wx')
 async def wechat_message_handle(data):
     """ 消息处理 """
-    logger.info("[wechat] route, message info: {} ".format(data))
+    wechat_logger.info("[wechat] route, message info: %s ", data)
     try:
         msg_handle = MsgHandle(data)
         reply = msg_handle.run()
         return reply if reply else 'success'
     except Exception as e:
-        logger.debug('[wechat] route: error. %s ' % str(e))
+        wechat_logger.debug('[wechat] route: error. %s ', e)
         return 'success'
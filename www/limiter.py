@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+""" 准入控制
+
+每个路由一个并发限制器，超过并发数的请求进入有界等待队列，队列满或等待超时时
+拒绝(503)；并发数可按观测到的延迟自动调整。对登录、注册等开销大的接口按客户端
+做令牌桶限流(429)。
+"""
+
+import time
+import asyncio
+import collections
+
+
+class Rejected(Exception):
+    """ 请求被拒绝，retry_after 为建议的重试秒数 """
+    def __init__(self, status, retry_after, reason):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class ConcurrencyLimiter(object):
+    """ 并发限制器
+
+    :param limit-初始并发数
+    :param queue-等待队列长度，0 表示不排队
+    :param queue_timeout-排队超时(秒)
+    :param adaptive-按延迟调整并发数：窗口平均延迟超过 target_latency 时
+        乘以 0.9 减小，否则在并发跑满时加一，范围 [min_limit, max_limit]
+    """
+    WINDOW = 50  # 每多少个请求调整一次
+
+    def __init__(self, limit=50, queue=100, queue_timeout=5,
+                 adaptive=False, target_latency=0.5,
+                 min_limit=2, max_limit=None):
+        self.limit = limit
+        self.queue = queue
+        self.queue_timeout = queue_timeout
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        self.min_limit = min_limit
+        self.max_limit = max_limit or limit * 4
+        self.in_flight = 0
+        self.rejected = 0
+        self._waiters = collections.deque()
+        self._window_count = 0
+        self._window_sum = 0.0
+        self._window_saturated = False
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    async def acquire(self):
+        """ 获取执行许可，无法获取时抛出 Rejected """
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.queue:
+            self.rejected += 1
+            raise Rejected(503, 1, 'Server busy')
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await asyncio.wait_for(fut, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise Rejected(503, 1, 'Server busy')
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                # 已获得许可但被取消，交给下一个
+                self.release(None)
+            raise
+        finally:
+            if not fut.done():
+                fut.cancel()
+            try:
+                self._waiters.remove(fut)
+            except ValueError:
+                pass
+
+    def release(self, latency):
+        """ 归还许可，latency 为本次请求耗时(秒) """
+        self.in_flight -= 1
+        if latency is not None and self.adaptive:
+            self._observe(latency)
+        self._wakeup()
+
+    def _wakeup(self):
+        while self._waiters and self.in_flight < self.limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.in_flight += 1
+                fut.set_result(None)
+
+    def _observe(self, latency):
+        """ 按窗口平均延迟调整并发数 """
+        self._window_count += 1
+        self._window_sum += latency
+        if self.in_flight + 1 >= self.limit:
+            self._window_saturated = True
+        if self._window_count < self.WINDOW:
+            return
+        average = self._window_sum / self._window_count
+        if average > self.target_latency:
+            self.limit = max(self.min_limit, int(self.limit * 0.9))
+        elif self._window_saturated:
+            self.limit = min(self.max_limit, self.limit + 1)
+        self._window_count = 0
+        self._window_sum = 0.0
+        self._window_saturated = False
+
+    def stats(self):
+        return dict(limit=self.limit, in_flight=self.in_flight,
+                    queued=self.queued, rejected=self.rejected)
+
+
+class TokenBucket(object):
+    """ 按客户端的令牌桶，rate 为每秒补充的令牌数，burst 为桶容量 """
+    MAX_CLIENTS = 10000
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.rejected = 0
+        self._buckets = {}  # 客户端 => [令牌数, 上次更新时间]
+
+    def take(self, client):
+        """ 取一个令牌，没有令牌时抛出 Rejected """
+        now = time.monotonic()
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_CLIENTS:
+                self._prune(now)
+            bucket = self._buckets[client] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            self.rejected += 1
+            raise Rejected(429, int((1 - bucket[0]) / self.rate) + 1,
+                           'Too many requests')
+        bucket[0] -= 1
+
+    def _prune(self, now):
+        """ 移除已经补满的桶，与新建的桶等价 """
+        full = (self.burst - 1) / self.rate if self.rate else 0
+        for client in [c for c, b in self._buckets.items() if now - b[1] >= full]:
+            del self._buckets[client]
+
+
+class AdmissionControl(object):
+    """ 按路由创建限制器
+
+    conf = {
+        'default': {'limit': 50, 'queue': 100, ...},  # ConcurrencyLimiter 参数
+        'routes': {'/api/authenticate': {'rate': 1, 'burst': 5, 'limit': 10}},
+        'exempt': ['/static']
+    }
+    路由配置中的 rate/burst 开启按客户端限流，其余项覆盖 default
+    """
+
+    def __init__(self, conf=None):
+        conf = conf or {}
+        self._default = dict(conf.get('default', {}))
+        self._routes = conf.get('routes', {})
+        self._exempt = tuple(conf.get('exempt', ()))
+        self._limiters = {}  # 路由 => ConcurrencyLimiter
+        self._buckets = {}  # 路由 => TokenBucket
+        for route, options in self._routes.items():
+            if 'rate' in options:
+                self._buckets[route] = TokenBucket(
+                    options['rate'], options.get('burst', options['rate']))
+
+    def limiter(self, route):
+        """ 路由的并发限制器，豁免的路由返回 None """
+        try:
+            return self._limiters[route]
+        except KeyError:
+            pass
+        if route.startswith(self._exempt):
+            limiter = None
+        else:
+            options = dict(self._default)
+            options.update((k, v) for k, v in self._routes.get(route, {}).items()
+                           if k not in ('rate', 'burst'))
+            limiter = ConcurrencyLimiter(**options)
+        self._limiters[route] = limiter
+        return limiter
+
+    def admit(self, route, client):
+        """ 按客户端限流，返回路由的并发限制器 """
+        bucket = self._buckets.get(route)
+        if bucket is not None:
+            bucket.take(client)
+        return self.limiter(route)
+
+    def stats(self):
+        """ 每个路由的限制器状态 """
+        stats = {route: limiter.stats()
+                 for route, limiter in self._limiters.items() if limiter}
+        for route, bucket in self._buckets.items():
+            stats.setdefault(route, {})['rate_limited'] = bucket.rejected
+        return stats
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+""" 运行指标
+
+计数器和直方图保存在内存中，render() 输出 Prometheus 文本格式，由 /metrics 提供。
+记录只做字典查找和加法，格式化在抓取时进行。
+"""
+
+import bisect
+import contextvars
+
+# 延迟直方图的默认分桶(秒)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """ 计数器，inc(*标签值) """
+    kind = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield self.name, _labels(self.labels, labels), value
+
+
+class Gauge(Counter):
+    """ 瞬时值，set(value, *标签值) """
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+
+class Histogram(object):
+    """ 直方图，observe(value, *标签值) """
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # 标签值 => [各桶计数..., 总和]
+
+    def observe(self, value, *labels):
+        data = self._values.get(labels)
+        if data is None:
+            data = self._values[labels] = [0] * (len(self.buckets) + 2)
+        data[bisect.bisect_left(self.buckets, value)] += 1
+        data[-1] += value
+
+    def samples(self):
+        for labels, data in sorted(self._values.items()):
+            total = 0
+            for le, n in zip(self.buckets + ('+Inf',), data):
+                total += n
+                yield (self.name + '_bucket',
+                       _labels(self.labels, labels, ('le', le)), total)
+            yield self.name + '_sum', _labels(self.labels, labels), data[-1]
+            yield self.name + '_count', _labels(self.labels, labels), total
+
+
+class Registry(object):
+    """ 指标注册表 """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        return self.register(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        return self.register(Gauge(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=BUCKETS):
+        return self.register(Histogram(name, doc, labels, buckets))
+
+    def collector(self, fn):
+        """ 注册抓取前调用的函数，用于更新 Gauge """
+        self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        """ Prometheus 文本格式 """
+        for fn in self._collectors:
+            fn()
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.doc))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{0}{1} {2}'.format(name, labels, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter(
+    'http_requests_total', 'HTTP requests', ('method', 'route', 'status'))
+REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_duration_seconds', 'HTTP request latency', ('method', 'route'))
+REQUEST_SQL = REGISTRY.histogram(
+    'http_request_sql_queries', 'SQL statements per request', ('route',),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50))
+REQUEST_SQL_SECONDS = REGISTRY.histogram(
+    'http_request_sql_seconds', 'SQL time per request', ('route',))
+SQL_SECONDS = REGISTRY.histogram(
+    'sql_query_duration_seconds', 'SQL statement latency', ('kind',))
+REDIS_SECONDS = REGISTRY.histogram(
+    'redis_command_duration_seconds', 'Redis command latency', ('command',))
+TEMPLATE_SECONDS = REGISTRY.histogram(
+    'template_render_seconds', 'Template render time', ('template',))
+DB_POOL = REGISTRY.gauge(
+    'db_pool_connections', 'Database pool connections', ('pool', 'state'))
+ADMISSION = REGISTRY.gauge(
+    'admission_requests', 'Admission control state per route', ('route', 'state'))
+
+# 当前请求的 [语句数, 语句耗时]
+_request_sql = contextvars.ContextVar('request_sql', default=None)
+
+
+def request_scope():
+    """ 开始统计当前请求的 SQL，返回 (统计, token) """
+    stats = [0, 0.0]
+    return stats, _request_sql.set(stats)
+
+
+def end_request(route, token, stats):
+    """ 结束当前请求的 SQL 统计 """
+    _request_sql.reset(token)
+    REQUEST_SQL.observe(stats[0], route)
+    REQUEST_SQL_SECONDS.observe(stats[1], route)
+
+
+def observe_sql(kind, seconds):
+    """ orm.on_query 回调 """
+    SQL_SECONDS.observe(seconds, kind)
+    stats = _request_sql.get()
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += seconds
+
+
+def observe_redis(command, seconds):
+    """ rediscache.Cache.on_call 回调 """
+    REDIS_SECONDS.observe(seconds, command)
+
+
+def install(admission=None):
+    """ 注册 orm 和 redis 的回调，admission 为 limiter.AdmissionControl """
+    import orm
+    orm.on_query(observe_sql)
+
+    if admission is not None:
+        @REGISTRY.collector
+        def collect_admission():
+            for route, stats in admission.stats().items():
+                for state, value in stats.items():
+                    ADMISSION.set(value, route, state)
+
+    @REGISTRY.collector
+    def collect_pools():
+        for pool in orm.pool_stats():
+            DB_POOL.set(pool['in_use'], pool['name'], 'in_use')
+            DB_POOL.set(pool['free'], pool['name'], 'free')
+            DB_POOL.set(pool['waiting'], pool['name'], 'waiting')
+
+    try:
+        from module.rediscache import Cache
+    except ImportError:
+        # 未安装 redis
+        return
+    Cache.on_call(observe_redis)
@@ -2,7 +2,7 @@
 
 import time
 import uuid
-from orm import Model, StringField, BooleanField, IntegerField, FloatField, TextField
+from orm import Model, StringField, BooleanField, IntegerField, FloatField, TextField, Index
 
 
 def next_id():
@@ -14,7 +14,7 @@ class User(Model):
     __table__ = 'users'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(64)')
-    email = StringField(ddl='varchar(64)')
+    email = StringField(ddl='varchar(64)', unique=True)
     passwd = StringField(ddl='varchar(64)')
     admin = BooleanField()
     name = StringField()
@@ -25,6 +25,11 @@ class User(Model):
 class Blog(Model):
     """ 博客表 """
     __table__ = 'blogs'
+    # 按时间倒序列表和键集分页
+    __indexes__ = [Index('created_at', 'id')]
+    # 修改时 version 加一、更新 updated_at，用于 ETag/Last-Modified
+    __version_field__ = 'version'
+    __modified_field__ = 'updated_at'
 
     id = StringField(primary_key=True, default=next_id)
     user_id = StringField(ddl='varchar(64)')
@@ -32,6 +37,8 @@ class Blog(Model):
     summary = StringField(ddl='varchar(200)')
     content = TextField()
     created_at = FloatField(default=time.time)
+    version = IntegerField(default=0)
+    updated_at = FloatField(default=time.time)
 
 
 class Comment(Model):
@@ -5,12 +5,35 @@ from . import Instance
 import json
 import os
 import sys
+import time
 import hashlib
 import logging
 from functools import wraps, partial
 logging.basicConfig(level=logging.DEBUG)
 
 
+_call_hooks = []  # redis 调用完成后的回调 fn(command, seconds)
+
+
+def on_call(fn):
+    """ 注册 redis 调用回调 fn(command, seconds) """
+    _call_hooks.append(fn)
+    return fn
+
+
+def _timed(command, func, *args):
+    """ 执行 redis 命令并通知回调 """
+    if not _call_hooks:
+        return func(*args)
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        elapsed = time.perf_counter() - start
+        for fn in _call_hooks:
+            fn(command, elapsed)
+
+
 def attach_wrapper(obj, func=None):
     if func is None:
         return partial(attach_wrapper, obj)
@@ -109,20 +132,20 @@ class Cache(object):
         if not key:
             key = str(self.key())
         logging.debug(f"redis set: {key}:{value},({self._ttl}s)")
-        return self._redis.set(key, value, self._ttl)
+        return _timed('set', self._redis.set, key, value, self._ttl)
 
     def get(self, key):
         """ 获取缓存 """
-        return self._redis.get(key)
+        return _timed('get', self._redis.get, key)
 
     def delete(self, key):
         """ 删除缓存 """
-        return self._redis.delete(key)
+        return _timed('delete', self._redis.delete, key)
 
     def remove(self, pattern):
         """ 批量删除缓存 """
         del_count = 0
-        keys = self._redis.keys(pattern)
+        keys = _timed('keys', self._redis.keys, pattern)
         for key in keys:
             if self.delete(key):
                 del_count += 1
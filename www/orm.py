@@ -1,60 +1,550 @@
 #!/usr/bin/python
 # -*- coding:utf-8 -*-
 # import pdb
-# import asyncio
-import aiomysql
-import datetime
-from functions import logger
+import asyncio
+import bisect
+import functools
+import contextlib
+import contextvars
+import itertools
+import time
+from functions import logger, sql_logger
+from backend import get_backend
+
+_SQL_CACHE_SIZE = 256  # 每种语句形态缓存的最大条数
+_sql_compilers = []  # 所有带缓存的SQL编译函数
+_transaction = contextvars.ContextVar('transaction', default=None)  # 当前事务
+_identity_map = contextvars.ContextVar('identity_map', default=None)  # 请求内对象缓存
+_session = contextvars.ContextVar('session', default=None)  # 当前会话，用于写后读一致
+_last_write = {}  # 会话最后写入时间
+_replicas = []  # 只读从库连接池
+_replica_counter = itertools.count()
+_read_policy = 'round_robin'
+_ryw_window = 5
+_backend = None  # 数据库后端，由 create_pool 设置
+_query_hooks = []  # 语句执行完成后的回调 fn(kind, seconds)
+_tracked_queries = None  # 记录执行过的查询 {sql: args}，用于索引检查
+_TRACKED_QUERIES_SIZE = 1000
+_placeholder = '%s'  # 后端驱动使用的参数占位符
 
 
 def log(sql, args=()):
-    logger.info('{0}\n\tsql: {1}\n\t args: {2}\n'.format(datetime.datetime.now(), sql, args))
+    sql_logger.info('sql: %s args: %s', sql, args)
 
 
 async def create_pool(loop, **kw):
-    """ 创建连接池 """
+    """ 创建连接池
+
+    :param backend-数据库后端 'mysql'(默认) 或 'sqlite'
+    :param replicas-只读从库配置列表，每项覆盖主库的同名配置，
+        读请求按 read_policy('round_robin' 或 'least_busy') 分发到从库
+    :param read_your_writes-同一会话写入后多少秒内的读请求仍走主库
+    :param acquire_timeout-获取连接的超时时间(秒)，超时抛出 PoolTimeoutError
+    :param ping_interval-空闲连接保活检测间隔(秒)，0 表示不检测
+    """
     logger.info('create database connection pool...')
-    global __pool
-    __pool = await aiomysql.create_pool(
-        host=kw.get('host', 'localhost'),
-        port=kw.get('post', 3306),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['db'],
-        charset=kw.get('charset', 'utf8'),
-        autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
-        loop=loop
-    )
+    global __pool, _replicas, _read_policy, _ryw_window, _backend, _placeholder
+    _backend = get_backend(kw.pop('backend', 'mysql'))
+    _placeholder = _backend.placeholder
+    sql_cache_clear()  # 已编译的SQL与后端的占位符相关
+    replicas = kw.pop('replicas', None) or ()
+    _read_policy = kw.pop('read_policy', 'round_robin')
+    _ryw_window = kw.pop('read_your_writes', 5)
+    acquire_timeout = kw.pop('acquire_timeout', None)
+    ping_interval = kw.pop('ping_interval', 30)
+    primary, pools = await _backend.create_pools(loop, replicas, **kw)
+    __pool = MonitoredPool(primary, 'primary', acquire_timeout)
+    _replicas = [
+        MonitoredPool(pool, 'replica{}'.format(i), acquire_timeout)
+        for i, pool in enumerate(pools)
+    ]
+    for pool in _pools():
+        await pool.warmup()
+    if ping_interval:
+        start_pool_health(ping_interval)
+
+
+class PoolTimeoutError(Exception):
+    """ 获取数据库连接超时 """
+
+
+class MonitoredPool(object):
+    """ 连接池包装，统计获取连接的等待时间、使用中连接数和超时次数 """
+    # 等待时间直方图分桶上限(秒)
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self, pool, name, acquire_timeout=None):
+        self.pool = pool
+        self.name = name
+        self.acquire_timeout = acquire_timeout
+        self.acquired = 0  # 获取连接次数
+        self.timeouts = 0  # 超时次数
+        self.waiting = 0  # 正在等待连接的协程数
+        self.max_in_use = 0  # 使用中连接数峰值
+        self.wait_sum = 0.0  # 等待时间总和
+        self.wait_buckets = [0] * (len(self.BUCKETS) + 1)
+        self.ping_failures = 0  # 保活检测失败次数
+
+    @property
+    def size(self):
+        return self.pool.size
+
+    @property
+    def freesize(self):
+        return self.pool.freesize
+
+    @property
+    def minsize(self):
+        return self.pool.minsize
+
+    @property
+    def maxsize(self):
+        return self.pool.maxsize
+
+    @property
+    def in_use(self):
+        """ 使用中的连接数 """
+        return self.pool.size - self.pool.freesize
+
+    async def acquire(self):
+        """ 获取连接，超过 acquire_timeout 抛出 PoolTimeoutError """
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            if self.acquire_timeout:
+                conn = await asyncio.wait_for(
+                    self.pool.acquire(), self.acquire_timeout)
+            else:
+                conn = await self.pool.acquire()
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise PoolTimeoutError(
+                'acquire connection from {0} pool timeout after {1}s'.format(
+                    self.name, self.acquire_timeout))
+        finally:
+            self.waiting -= 1
+        elapsed = time.perf_counter() - start
+        self.acquired += 1
+        self.wait_sum += elapsed
+        self.wait_buckets[bisect.bisect_left(self.BUCKETS, elapsed)] += 1
+        in_use = self.in_use
+        if in_use > self.max_in_use:
+            self.max_in_use = in_use
+        return conn
+
+    def release(self, conn):
+        """ 归还连接 """
+        return self.pool.release(conn)
+
+    async def warmup(self):
+        """ 预先建立 minsize 个连接并检测可用 """
+        conns = []
+        try:
+            for _ in range(self.pool.minsize):
+                conns.append(await self.pool.acquire())
+            for conn in conns:
+                await conn.ping(reconnect=True)
+        finally:
+            for conn in conns:
+                await self.pool.release(conn)
+        logger.info('{0} pool warmed up: {1} connections'.format(
+            self.name, self.pool.size))
+
+    async def ping(self):
+        """ 检测空闲连接，失效的连接关闭后由连接池回收 """
+        conns = []
+        try:
+            # 只检测当前空闲的连接，不与请求争抢连接
+            for _ in range(self.pool.freesize):
+                if self.pool.freesize == 0:
+                    break
+                conns.append(await self.pool.acquire())
+            for conn in conns:
+                try:
+                    await conn.ping(reconnect=False)
+                except Exception as e:
+                    self.ping_failures += 1
+                    logger.warning('{0} pool ping failed: {1}'.format(
+                        self.name, e))
+                    conn.close()
+        finally:
+            for conn in conns:
+                await self.pool.release(conn)
+
+    def stats(self):
+        """ 连接池统计 """
+        buckets = []
+        total = 0
+        for le, n in zip(self.BUCKETS + ('+Inf',), self.wait_buckets):
+            total += n
+            buckets.append((le, total))
+        return dict(
+            name=self.name,
+            size=self.pool.size,
+            free=self.pool.freesize,
+            in_use=self.in_use,
+            max_in_use=self.max_in_use,
+            minsize=self.pool.minsize,
+            maxsize=self.pool.maxsize,
+            waiting=self.waiting,
+            acquired=self.acquired,
+            timeouts=self.timeouts,
+            ping_failures=self.ping_failures,
+            wait_sum=self.wait_sum,
+            wait_buckets=buckets
+        )
+
+
+def _pools():
+    """ 所有连接池 """
+    return [__pool] + _replicas
+
+
+def pool_stats():
+    """ 所有连接池的统计信息 """
+    return [pool.stats() for pool in _pools()]
+
+
+def start_pool_health(interval=30):
+    """ 定时检测空闲连接 """
+    async def health():
+        while True:
+            await asyncio.sleep(interval)
+            for pool in _pools():
+                try:
+                    await pool.ping()
+                except Exception as e:
+                    logger.exception(e)
+    return asyncio.ensure_future(health())
+
+
+def _primary():
+    """ 主库连接池 """
+    return __pool
+
+
+def _in_write_window():
+    """ 当前会话是否处于写后读窗口 """
+    key = _session.get()
+    if key is None:
+        return False
+    t = _last_write.get(key)
+    return t is not None and time.monotonic() - t < _ryw_window
+
+
+def _read_pool():
+    """ 选择读连接池: 无从库或会话处于写后读窗口时使用主库 """
+    if not _replicas or _in_write_window():
+        return __pool
+    if _read_policy == 'least_busy':
+        return min(_replicas, key=lambda p: p.size - p.freesize)
+    return _replicas[next(_replica_counter) % len(_replicas)]
+
+
+def _mark_write():
+    """ 记录当前会话的写入时间，用于写后读一致 """
+    key = _session.get()
+    if key is None:
+        return
+    now = time.monotonic()
+    if len(_last_write) > 1024:
+        # 清理过期的会话记录
+        for k, t in list(_last_write.items()):
+            if now - t >= _ryw_window:
+                del _last_write[k]
+    _last_write[key] = now
+
+
+@contextlib.contextmanager
+def session_scope(key):
+    """ 标记当前会话(如用户id)，会话写入后的短时间内读请求走主库 """
+    token = _session.set(key)
+    try:
+        yield
+    finally:
+        _session.reset(token)
+
+
+def _driver_sql(sql):
+    """ 将 ? 占位符转换为驱动使用的占位符，如 aiomysql 的 %s """
+    if _placeholder == '?':
+        return sql
+    return sql.replace('?', _placeholder)
+
+
+def compiled(func):
+    """ SQL编译缓存装饰器，按参数缓存最终可执行的SQL """
+    func = functools.lru_cache(maxsize=_SQL_CACHE_SIZE)(func)
+    _sql_compilers.append(func)
+    return func
+
+
+def sql_cache_info():
+    """ SQL编译缓存命中统计 """
+    return {f.__name__: f.cache_info()._asdict() for f in _sql_compilers}
+
+
+def sql_cache_clear():
+    """ 清空SQL编译缓存 """
+    for f in _sql_compilers:
+        f.cache_clear()
 
 
 async def select(sql, args, size=None):
     """ 查询 """
-    log(sql, args)
-    global __pool
-    async with __pool.get() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute(sql.replace('?', '%s'), args or ())
-            if size:
-                rs = await cur.fetchmany(size)
+    return await _select(_driver_sql(sql), args, size)
+
+
+@contextlib.asynccontextmanager
+async def _connection(read=False, pool=None):
+    """ 获取连接，事务中复用事务固定的连接
+
+    :param read-只读查询，可分发到从库
+    :param pool-指定连接池，调用者已选择好读连接池时使用
+    """
+    tx = _transaction.get()
+    if tx is not None:
+        yield tx.conn
+        return
+    if pool is None:
+        pool = _read_pool() if read else _primary()
+    conn = await pool.acquire()
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+
+class Transaction(object):
+    """ 事务，整个 async with 块固定使用同一连接
+
+    async with orm.transaction() as tx:
+        await blog.remove()
+        ...
+    正常退出时提交，异常时回滚；嵌套的事务使用保存点。
+    事务内不要并发执行查询（如 asyncio.gather），同一连接不能并发使用。
+    事务内对缓存行数的调整在提交后才生效，回滚时丢弃。
+    """
+    def __init__(self):
+        self.pool = None
+        self.conn = None
+        self.parent = None
+        self.savepoint = None
+        self.counts = {}  # 模型 => 行数变化，None 表示提交后丢弃缓存
+        self._token = None
+
+    async def __aenter__(self):
+        self.parent = _transaction.get()
+        if self.parent is None:
+            _mark_write()
+            self.pool = _primary()
+            self.conn = await self.pool.acquire()
+            try:
+                await self.conn.begin()
+            except BaseException:
+                await self.pool.release(self.conn)
+                raise
+        else:
+            self.conn = self.parent.conn
+            self.savepoint = 'sp_{}'.format(id(self))
+            await self._query('SAVEPOINT {}'.format(self.savepoint))
+        self._token = _transaction.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        _transaction.reset(self._token)
+        if self.parent is not None:
+            if exc_type is None:
+                await self._query('RELEASE SAVEPOINT {}'.format(self.savepoint))
+                for cls, delta in self.counts.items():
+                    self.parent.count_changed(cls, delta)
+            else:
+                await self._query(
+                    'ROLLBACK TO SAVEPOINT {}'.format(self.savepoint))
+            return False
+        try:
+            if exc_type is None:
+                await self.conn.commit()
+                for cls, delta in self.counts.items():
+                    if delta is None:
+                        _count_invalidate(cls)
+                    else:
+                        _count_adjust(cls, delta)
             else:
-                rs = await cur.fetchall()
-        logger.debug('rows returned: {}'.format(len(rs)))
-        return rs
+                await self.conn.rollback()
+        finally:
+            await self.pool.release(self.conn)
+        return False
+
+    def count_changed(self, cls, delta):
+        """ 记录事务内的行数变化，delta 为 None 表示无法确定 """
+        if delta is None or self.counts.get(cls, 0) is None:
+            self.counts[cls] = None
+        else:
+            self.counts[cls] = self.counts.get(cls, 0) + delta
+
+    async def _query(self, sql):
+        """ 在事务连接上执行语句 """
+        log(sql)
+        async with self.conn.cursor() as cur:
+            await cur.execute(sql)
+
+
+def transaction():
+    """ 创建事务 async with orm.transaction() as tx: """
+    return Transaction()
+
+
+def in_transaction():
+    """ 当前是否处于事务中 """
+    return _transaction.get() is not None
+
+
+def track_queries(enable=True):
+    """ 开始/停止记录 orm 执行的查询语句，供 schema 检查索引 """
+    global _tracked_queries
+    _tracked_queries = {} if enable else None
+
+
+def tracked_queries():
+    """ 已记录的查询 {sql: args}，sql 为驱动可执行的语句 """
+    return dict(_tracked_queries or {})
+
+
+def _forget_model(cls):
+    """ 从对象缓存移除模型的全部对象 """
+    imap = _identity_map.get()
+    if imap:
+        for key in [k for k in imap if k[0] is cls]:
+            del imap[key]
+
+
+@contextlib.contextmanager
+def identity_scope():
+    """ 开启对象缓存(identity map)，块内按主键查询到的对象会被复用
+
+    由 app 中间件为每个请求开启，写操作会同步更新缓存
+    """
+    token = _identity_map.set({})
+    try:
+        yield
+    finally:
+        _identity_map.reset(token)
+
+
+async def _select(sql, args, size=None, cursor='dict', pool=None):
+    """ 查询，sql 已是驱动可执行的语句
+
+    :param cursor-游标类型，默认 'dict' 每行返回 dict，'tuple' 返回 tuple
+    :param pool-指定读连接池，默认由 _read_pool() 选择
+    """
+    log(sql, args)
+    if (_tracked_queries is not None and sql not in _tracked_queries and
+            len(_tracked_queries) < _TRACKED_QUERIES_SIZE and
+            not sql.startswith(_backend.explain_prefix)):
+        _tracked_queries[sql] = list(args or ())
+    start = time.perf_counter()
+    try:
+        async with _connection(read=True, pool=pool) as conn:
+            async with conn.cursor(_backend.cursors[cursor]) as cur:
+                await cur.execute(sql, args or ())
+                if size:
+                    rs = await cur.fetchmany(size)
+                else:
+                    rs = await cur.fetchall()
+            logger.debug('rows returned: %s', len(rs))
+            return rs
+    finally:
+        if _query_hooks:
+            _notify_query('select', start)
+
+
+class Streaming(object):
+    """ 流式查询结果，可直接 async for，也可作为 async with 使用
+
+    async with Blog.iter_all() as blogs:
+        async for blog in blogs:
+            ...
+    退出 async with 时立即关闭查询并归还连接，即使中途 break；
+    直接 async for 提前退出时，连接要等生成器被回收时才释放
+    """
+    def __init__(self, agen):
+        self._agen = agen
+
+    def __aiter__(self):
+        return self._agen
+
+    async def __aenter__(self):
+        return self._agen
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._agen.aclose()
+        return False
+
+    async def aclose(self):
+        await self._agen.aclose()
+
+
+def stream(sql, args, batch=500):
+    """ 流式查询，每次产出 batch 条记录，返回 Streaming """
+    return Streaming(_stream(_driver_sql(sql), args, batch))
+
+
+async def _stream(sql, args, batch=500):
+    """ 流式查询，sql 已是驱动可执行的语句，使用无缓冲的服务端游标
+
+    提前退出时连接上仍有未读取的结果，直接关闭该连接再归还连接池，
+    避免为了释放连接而读完剩余数据；事务中的连接不能关闭，只能读完剩余数据
+    """
+    log(sql, args)
+    tx = _transaction.get()
+    if tx is not None:
+        conn = tx.conn
+    else:
+        pool = _read_pool()
+        conn = await pool.acquire()
+    exhausted = False
+    cur = None
+    try:
+        cur = await conn.cursor(_backend.cursors['stream'])
+        await cur.execute(sql, args or ())
+        while True:
+            rs = await cur.fetchmany(batch)
+            if not rs:
+                exhausted = True
+                break
+            yield rs
+        await cur.close()
+    finally:
+        if tx is not None:
+            if not exhausted and cur is not None:
+                await cur.close()
+        else:
+            if not exhausted:
+                conn.close()
+            await pool.release(conn)
 
 
 async def execute(sql, args, autocommit=True):
     """ 执行SQL :param autocommit-自动提交，不自动提交则使用事务 """
+    return await _execute(_driver_sql(sql), args, autocommit)
+
+
+async def _execute(sql, args, autocommit=True):
+    """ 执行SQL，sql 已是驱动可执行的语句，事务中由事务统一提交 """
     log(sql, args)
-    async with __pool.get() as conn:
+    if in_transaction():
+        autocommit = True
+    _mark_write()
+    start = time.perf_counter()
+    async with _connection() as conn:
         if not autocommit:
             await conn.begin()
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
+            async with conn.cursor() as cur:
                 logger.debug(sql)
                 logger.debug(args)
-                await cur.execute(sql.replace('?', '%s'), args)
+                await cur.execute(sql, args)
                 affected = cur.rowcount
             if not autocommit:
                 await conn.commit()
@@ -62,9 +552,67 @@ async def execute(sql, args, autocommit=True):
             if not autocommit:
                 await conn.rollback()
             raise e
+        finally:
+            if _query_hooks:
+                _notify_query('execute', start)
         return affected
 
 
+async def executemany(sql, seq_args, size=500):
+    """ 批量执行同一SQL，按 size 分批，返回每批影响行数 """
+    return await _executemany(_driver_sql(sql), seq_args, size)
+
+
+async def _executemany(sql, seq_args, size=500):
+    """ 批量执行，sql 已是驱动可执行的语句 """
+    seq_args = list(seq_args)
+    return await _execute_batches(
+        (sql, seq_args[i:i + size], True)
+        for i in range(0, len(seq_args), size)
+    )
+
+
+async def _execute_batches(batches):
+    """ 在同一连接、同一事务内执行多批语句
+
+    :param batches-(sql, args, many) 迭代器，many 为真时使用 executemany
+    :return 每批影响行数列表
+    """
+    counts = []
+    async with transaction() as tx:
+        async with tx.conn.cursor() as cur:
+            for sql, args, many in batches:
+                start = time.perf_counter()
+                if many:
+                    log(sql, '<{} rows>'.format(len(args)))
+                    await cur.executemany(sql, args)
+                else:
+                    log(sql, args)
+                    await cur.execute(sql, args)
+                counts.append(cur.rowcount)
+                if _query_hooks:
+                    _notify_query('execute', start)
+    return counts
+
+
+def on_query(fn):
+    """ 注册语句执行回调 fn(kind, seconds)，kind 为 'select' 或 'execute'
+
+    回调在事件循环中同步调用，应尽量轻量
+    """
+    _query_hooks.append(fn)
+    return fn
+
+
+def _notify_query(kind, start):
+    elapsed = time.perf_counter() - start
+    for fn in _query_hooks:
+        try:
+            fn(kind, elapsed)
+        except Exception as e:
+            logger.exception(e)
+
+
 def create_args_string(num):
     """ 创建参数字符串 """
     L = []
@@ -74,12 +622,19 @@ def create_args_string(num):
 
 
 class Field(object):
-    """ 字段类，保存字段名和字段类型 """
-    def __init__(self, name, column_type, primary_key, default):
+    """ 字段类，保存字段名和字段类型
+
+    :param index-为该字段建立索引
+    :param unique-为该字段建立唯一索引
+    """
+    def __init__(self, name, column_type, primary_key, default,
+                 index=False, unique=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.index = index
+        self.unique = unique
 
     def __str__(self):
         """ 字段描述 """
@@ -97,27 +652,31 @@ class StringField(Field):
         name=None,
         primary_key=False,
         default=None,
-        ddl='varchar(100)'
+        ddl='varchar(100)',
+        index=False,
+        unique=False
     ):
-        super().__init__(name, ddl, primary_key, default)
+        super().__init__(name, ddl, primary_key, default, index, unique)
 
 
 class BooleanField(Field):
     """ 布尔类型 """
-    def __init__(self, name=None, default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index)
 
 
 class IntegerField(Field):
     """ 整数类型 """
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0,
+                 index=False, unique=False):
+        super().__init__(name, 'bigint', primary_key, default, index, unique)
 
 
 class FloatField(Field):
     """ 浮点类型 """
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0,
+                 index=False, unique=False):
+        super().__init__(name, 'real', primary_key, default, index, unique)
 
 
 class TextField(Field):
@@ -126,6 +685,366 @@ class TextField(Field):
         super().__init__(name, 'text', False, default)
 
 
+class Index(object):
+    """ 索引定义，用于模型的 __indexes__
+
+    __indexes__ = [('created_at', 'id'), Index('email', unique=True)]
+    """
+    def __init__(self, *fields, unique=False, name=None):
+        self.fields = tuple(fields)
+        self.unique = unique
+        self.name = name
+
+    def __str__(self):
+        return "<{0}{1}: {2}>".format(
+            'Unique' if self.unique else '',
+            self.__class__.__name__,
+            ','.join(self.fields)
+        )
+
+    __repr__ = __str__
+
+
+def _index_defs(table, mappings, indexes):
+    """ 整理字段上的 index/unique 和 __indexes__ 中的索引定义 """
+    defs = []
+    for k, v in mappings.items():
+        if not v.primary_key and (v.index or v.unique):
+            defs.append(Index(k, unique=v.unique))
+    for index in indexes:
+        if not isinstance(index, Index):
+            index = Index(*index)
+        defs.append(index)
+    for index in defs:
+        for f in index.fields:
+            if f not in mappings:
+                raise BaseException('Index field not found: {}'.format(f))
+        if not index.name:
+            index.name = '{0}_{1}_{2}'.format(
+                'uq' if index.unique else 'idx', table, '_'.join(index.fields))
+    return defs
+
+
+def _limit_shape(limit):
+    """ limit 参数形态: None, 'int' 或 'tuple' """
+    if limit is None:
+        return None
+    if isinstance(limit, int):
+        return 'int'
+    if isinstance(limit, tuple) and len(limit) == 2:
+        return 'tuple'
+    raise ValueError('Invalid limit value: {}'.format(str(limit)))
+
+
+def _projection(cls, only=None, defer=None):
+    """ 计算要查询的非主键字段，返回 None 表示全部字段 """
+    if not only and not defer:
+        return None
+    for name in (only or ()) + (defer or ()):
+        if name not in cls.__mappings__:
+            raise ValueError('Invalid field: {}'.format(name))
+    if only:
+        return tuple(f for f in cls.__fields__ if f in only)
+    return tuple(f for f in cls.__fields__ if f not in defer)
+
+
+@compiled
+def _compile_select(cls, columns):
+    """ 编译只查询部分字段的 select 语句 """
+    if columns is None:
+        return cls.__select__
+    return "SELECT {0} FROM `{1}`".format(
+        ','.join('`{}`'.format(f) for f in (cls.__primary_key__,) + columns),
+        cls.__table__)
+
+
+@compiled
+def _compile_find_all(cls, where, orderBy, limit_shape, columns=None):
+    """ 编译 findAll 语句 """
+    sql = [_compile_select(cls, columns)]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    if orderBy:
+        sql.append('order by')
+        sql.append(orderBy)
+    if limit_shape == 'int':
+        sql.append('limit ?')
+    elif limit_shape == 'tuple':
+        sql.append('limit ?,?')
+    return _driver_sql(' '.join(sql))
+
+
+@compiled
+def _compile_seek_all(cls, where, seek, desc, after, limit_shape, columns=None):
+    """ 编译键集(seek)分页语句
+
+    按 seek 字段排序，after 为真时追加 "位于游标之后" 的条件:
+    (k1 < ? or (k1 = ? and k2 < ?))
+    """
+    op = '<' if desc else '>'
+    conds = []
+    if where:
+        conds.append('({})'.format(where))
+    if after:
+        ors = []
+        for i, key in enumerate(seek):
+            ands = ['`{}` = ?'.format(k) for k in seek[:i]]
+            ands.append('`{0}` {1} ?'.format(key, op))
+            ors.append('({})'.format(' and '.join(ands)))
+        conds.append('({})'.format(' or '.join(ors)))
+    orderBy = ', '.join(
+        '`{0}` {1}'.format(k, 'desc' if desc else 'asc') for k in seek)
+    return _compile_find_all(
+        cls, ' and '.join(conds), orderBy, limit_shape, columns)
+
+
+def _seek_args(after):
+    """ 展开游标值为 seek 条件参数 """
+    return [v for i in range(len(after)) for v in after[:i + 1]]
+
+
+@compiled
+def _compile_find_number(cls, select_field, where):
+    """ 编译 findNumber 语句 """
+    sql = ['select {0} as _num from `{1}`'.format(select_field, cls.__table__)]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    return _driver_sql(' '.join(sql))
+
+
+@compiled
+def _compile_find(cls, columns=None):
+    """ 编译主键查询语句 """
+    return _driver_sql("{0} where `{1}`=?".format(
+        _compile_select(cls, columns), cls.__primary_key__))
+
+
+@compiled
+def _compile_update(cls, columns):
+    """ 编译只更新部分字段的 update 语句 """
+    return _driver_sql("UPDATE `{0}` SET {1} WHERE `{2}`=?".format(
+        cls.__table__, _set_clause(cls, columns), cls.__primary_key__))
+
+
+def _set_clause(cls, columns):
+    """ update 的 SET 部分，模型有版本字段且未指定时版本号加一 """
+    sets = ['`{}`=?'.format(cls.__mappings__[f].name or f) for f in columns]
+    version = cls.__version_field__
+    if version and version not in columns:
+        sets.append('`{0}`=`{0}`+1'.format(version))
+    return ','.join(sets)
+
+
+@compiled
+def _compile_upsert(cls, columns):
+    """ 编译主键冲突时更新 columns 的插入语句，版本字段在原值上加一 """
+    version = cls.__version_field__
+    return _driver_sql(_backend.upsert_sql(
+        cls.__insert__, cls.__primary_key__,
+        [cls.__mappings__[f].name or f for f in columns if f != version],
+        [version] if version and columns else ()))
+
+
+@compiled
+def _compile_update_where(cls, columns, where):
+    """ 编译按条件更新部分字段的 update 语句 """
+    return _driver_sql("UPDATE `{0}` SET {1} WHERE {2}".format(
+        cls.__table__, _set_clause(cls, columns), where))
+
+
+def _upsert_columns(cls, update):
+    """ upsert 冲突时更新的字段，默认全部非主键字段 """
+    if update is None:
+        return tuple(cls.__fields__)
+    for f in update:
+        if f not in cls.__fields__:
+            raise ValueError('Invalid field: {}'.format(f))
+    return tuple(f for f in cls.__fields__ if f in update)
+
+
+@compiled
+def _compile_delete_in(cls, num):
+    """ 编译按主键批量删除语句 """
+    return _driver_sql("DELETE FROM `{0}` where `{1}` in ({2})".format(
+        cls.__table__, cls.__primary_key__, create_args_string(num)))
+
+
+@compiled
+def _compile_find_in(cls, num):
+    """ 编译按主键批量查询语句 """
+    return _driver_sql("{0} where `{1}` in ({2})".format(
+        cls.__select__, cls.__primary_key__, create_args_string(num)))
+
+
+_IN_BATCH_SIZE = 512  # 每条 in 查询的最大主键数
+
+
+async def _fetch_rows(cls, pks, pool=None):
+    """ 按主键批量查询，返回 {主键: 行}
+
+    参数个数向上补齐到 2 的幂，限制编译出的语句形态数量
+    """
+    rows = {}
+    pk = cls.__primary_key__
+    for i in range(0, len(pks), _IN_BATCH_SIZE):
+        chunk = pks[i:i + _IN_BATCH_SIZE]
+        size = 1 << (len(chunk) - 1).bit_length()
+        chunk = chunk + chunk[-1:] * (size - len(chunk))
+        for r in await _select(_compile_find_in(cls, size), chunk, pool=pool):
+            rows[r[pk]] = r
+    return rows
+
+
+class BatchLoader(object):
+    """ 合并同一轮事件循环中对同一模型的主键查询
+
+    多个协程在同一轮中调用 load(pk)，下一轮统一执行一条 in 查询，
+    每个调用者得到各自的查询结果行。
+    读连接池在调用者的上下文中选择，每个连接池一个待执行批次；
+    批量查询在空的上下文中执行，不属于任何一个调用者的会话和请求统计
+    """
+    def __init__(self, model):
+        self.model = model
+        self._pending = {}  # 连接池 => {主键: future}
+
+    def load(self, pk):
+        """ 返回主键对应行的 future，行不存在时结果为 None
+
+        处于写后读窗口的调用者应直接查询主库，不使用 BatchLoader
+        """
+        if self._pending and _replicas:
+            # 窗口外的调用者可以使用任一从库，加入已有批次
+            pool = next(iter(self._pending))
+        else:
+            pool = _read_pool()
+        pending = self._pending.get(pool)
+        if pending is None:
+            pending = self._pending[pool] = {}
+            asyncio.get_event_loop().call_soon(
+                self._dispatch, pool, context=contextvars.Context())
+        fut = pending.get(pk)
+        if fut is None:
+            fut = pending[pk] = asyncio.get_event_loop().create_future()
+        return fut
+
+    def _dispatch(self, pool):
+        pending = self._pending.pop(pool)
+        asyncio.ensure_future(self._fetch(pool, pending))
+
+    async def _fetch(self, pool, pending):
+        try:
+            rows = await _fetch_rows(self.model, list(pending), pool)
+        except BaseException as e:
+            for fut in pending.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for pk, fut in pending.items():
+            if not fut.done():
+                fut.set_result(rows.get(pk))
+
+
+_loaders = {}  # 模型 => BatchLoader
+_table_counts = {}  # 模型 => 表行数缓存
+_count_approximate = {}  # 模型 => 是否使用估算行数
+
+
+async def _count_rows(cls, approximate=False):
+    """ 查询表行数，approximate 时读取数据库的统计值(MySQL information_schema) """
+    if approximate and _backend.table_rows_sql:
+        rs = await select(_backend.table_rows_sql, [cls.__table__], 1)
+        if rs and rs[0]['_num'] is not None:
+            return int(rs[0]['_num'])
+    return await cls.findNumber('count(*)')
+
+
+def _count_adjust(cls, delta):
+    """ 写入后调整缓存的行数，事务中记录到事务，提交后再调整 """
+    tx = _transaction.get()
+    if tx is not None:
+        tx.count_changed(cls, delta)
+        return
+    n = _table_counts.get(cls)
+    if n is not None and delta:
+        _table_counts[cls] = max(n + delta, 0)
+
+
+def _count_invalidate(cls):
+    """ 无法确定行数变化时丢弃缓存，下次 count() 重新统计 """
+    tx = _transaction.get()
+    if tx is not None:
+        tx.count_changed(cls, None)
+        return
+    _table_counts.pop(cls, None)
+
+
+async def reconcile_counts():
+    """ 重新统计所有已缓存的表行数 """
+    for cls in list(_table_counts):
+        _table_counts[cls] = await _count_rows(
+            cls, _count_approximate.get(cls, False))
+
+
+def start_count_reconciler(interval=60):
+    """ 定时与数据库校准缓存的表行数 """
+    async def reconcile():
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await reconcile_counts()
+            except Exception as e:
+                logger.exception(e)
+    return asyncio.ensure_future(reconcile())
+
+
+def _batch_loader(cls):
+    """ 获取模型的 BatchLoader """
+    loader = _loaders.get(cls)
+    if loader is None:
+        loader = _loaders[cls] = BatchLoader(cls)
+    return loader
+
+
+class Record(object):
+    """ 只读记录基类，由 ModelMetaClass 为每个模型生成子类
+
+    使用 __slots__ 存储字段，直接由 tuple 行构造，用于只读的列表查询
+    """
+    __slots__ = ()
+
+    def _asdict(self):
+        """ 转换为 dict，用于 json 序列化 """
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__, ', '.join(
+            '{0}={1!r}'.format(k, getattr(self, k)) for k in self.__slots__))
+
+
+@functools.lru_cache(maxsize=None)
+def _record_type(cls, columns=None):
+    """ 生成模型的只读记录类型，columns 为 None 时包含全部字段 """
+    names = (cls.__primary_key__,) + (columns if columns is not None
+                                       else tuple(cls.__fields__))
+    # 生成 __init__: self.id, self.name, ... = row
+    ns = {}
+    exec("def __init__(self, row):\n    {}, = row\n".format(
+        ', '.join('self.' + n for n in names)), ns)
+    return type(cls.__name__ + 'Record', (Record,), {
+        '__slots__': names,
+        '__init__': ns['__init__'],
+        '__model__': cls
+    })
+
+
 class ModelMetaClass(type):
     """ 定义元类 """
     def __new__(cls, name, bases, attrs):
@@ -168,12 +1087,25 @@ class ModelMetaClass(type):
         attrs['__insert__'] = "INSERT INTO `{0}` ({1}, `{2}`) VALUES ({3})".format(tableName, ','.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = "UPDATE `{0}` SET {1} WHERE `{2}`=?".format(tableName, ','.join(map(lambda f: "`{}`=?".format(mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = "DELETE FROM `{0}` where `{1}`=?".format(tableName, primaryKey)
+        for key in ('__version_field__', '__modified_field__'):
+            if attrs.get(key) and attrs[key] not in fields:
+                raise BaseException('{0} field not found: {1}'.format(key, attrs[key]))
+        # 索引定义
+        attrs['__index_defs__'] = _index_defs(
+            tableName, mappings, attrs.get('__indexes__', ()))
 
-        return type.__new__(cls, name, bases, attrs)
+        model = type.__new__(cls, name, bases, attrs)
+        model.__record__ = _record_type(model)  # 只读记录类型
+        return model
 
 
 class Model(dict, metaclass=ModelMetaClass):
     """ 模型基类 """
+    _deferred = frozenset()  # 未加载的延迟字段
+    _changed = None  # 从数据库加载后被修改字段的原值，None 表示未从数据库加载
+    __version_field__ = None  # 版本号字段，update() 时加一
+    __modified_field__ = None  # 修改时间字段，update() 时更新
+
     def __init__(self, **kw):
         # logger.info('kw'+str(kw))        
         super().__init__(**kw)
@@ -183,11 +1115,41 @@ class Model(dict, metaclass=ModelMetaClass):
         try:
             return self[key]
         except KeyError:
+            if key in self._deferred:
+                raise AttributeError(
+                    r"deferred field '{}' is not loaded, "
+                    "await load() first".format(key))
             raise AttributeError(r"'Model' object has no attribute '{}'".format(key))
 
     def __setattr__(self, key, value):
         self[key] = value
 
+    def __setitem__(self, key, value):
+        changed = self._changed
+        if (changed is not None and key not in changed and
+                key in self.__mappings__):
+            # 记录字段第一次修改前的值
+            changed[key] = dict.get(self, key)
+        dict.__setitem__(self, key, value)
+
+    @classmethod
+    def _from_row(cls, row, deferred=None):
+        """ 由查询结果构造对象，开始记录字段修改 """
+        obj = cls(**row)
+        d = obj.__dict__
+        d['_changed'] = {}
+        if deferred:
+            d['_deferred'] = deferred
+        return obj
+
+    def dirty_fields(self):
+        """ 加载后值被修改过的非主键字段，未从数据库加载时返回 None """
+        changed = self._changed
+        if changed is None:
+            return None
+        return tuple(f for f in self.__fields__
+                     if f in changed and dict.get(self, f) != changed[f])
+
     def getValue(self, key):
         """ 获取值 """
         return getattr(self, key, None)
@@ -199,82 +1161,440 @@ class Model(dict, metaclass=ModelMetaClass):
             field = self.__mappings__[key]
             if field.default is not None:
                 value = field.default() if callable(field.default) else field.default
-                logger.debug("using default value for {0}: {1}".format(key, str(value)))
+                logger.debug("using default value for %s: %s", key, value)
                 setattr(self, key, value)
         return value
 
     @classmethod
     async def findAll(cls, where=None, args=None, **kw):
-        """ find objects by where clause. """
-        sql = [cls.__select__]
+        """ find objects by where clause.
 
-        if where:
-            sql.append('where')
-            sql.append(where)
+        键集分页: seek=('created_at', 'id') 指定排序字段（desc 默认为真），
+        after 为上一页最后一条记录的 seek 字段值，不使用 offset。
+        字段投影: only=[...] 只查询指定字段，defer=[...] 延迟加载指定字段，
+        未加载的字段可通过 await obj.load() 读取。
+        record=True 返回只读的 __record__ 对象而不是模型实例，用于只读列表。
+        """
         if args is None:
             args = []
+        limit = kw.get('limit', None)
+        shape = _limit_shape(limit)
+        seek = kw.get('seek', None)
+        only = kw.get('only', None)
+        if seek and only:
+            only = tuple(only) + tuple(seek)
+        columns = _projection(
+            cls,
+            tuple(only) if only else None,
+            tuple(kw['defer']) if kw.get('defer') else None)
+        if seek:
+            seek = tuple(seek)
+            after = kw.get('after', None)
+            if after is not None:
+                after = tuple(after)
+                if len(after) != len(seek):
+                    raise ValueError('Invalid after value: {}'.format(str(after)))
+                args.extend(_seek_args(after))
+            sql = _compile_seek_all(
+                cls, where, seek, kw.get('desc', True), after is not None,
+                shape, columns)
+        else:
+            sql = _compile_find_all(
+                cls, where, kw.get('orderBy', None), shape, columns)
+        if shape == 'int':
+            args.append(limit)
+        elif shape == 'tuple':
+            args.extend(limit)
+        if kw.get('record', False):
+            record = _record_type(cls, columns)
+            rs = await _select(sql, args, cursor='tuple')
+            return [record(r) for r in rs]
+        rs = await _select(sql, args)
+        if columns is None:
+            imap = _identity_map.get()
+            if imap is None:
+                return [cls._from_row(r) for r in rs]
+            # 已缓存的对象直接复用，保证同一请求中同一行只有一个对象
+            pk = cls.__primary_key__
+            objs = []
+            for r in rs:
+                key = (cls, r[pk])
+                obj = imap.get(key)
+                if obj is None:
+                    obj = imap[key] = cls._from_row(r)
+                objs.append(obj)
+            return objs
+        deferred = frozenset(cls.__fields__).difference(columns)
+        return [cls._from_row(r, deferred) for r in rs]
 
-        orderBy = kw.get('orderBy', None)
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
+    @classmethod
+    def iter_all(cls, where=None, args=None, batch=500, **kw):
+        """ 流式遍历查询结果，内存占用与 batch 成正比，返回 Streaming
+
+        async with Blog.iter_all(batch=500) as blogs:
+            async for blog in blogs: ...
+        可能提前 break 时使用 async with，退出时立即归还连接
+        """
+        return Streaming(cls._iter_rows(where, args, batch, **kw))
 
+    @classmethod
+    async def _iter_rows(cls, where, args, batch, **kw):
+        if args is None:
+            args = []
         limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2 :
-                sql.append('?,?')
-                args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value: {}'.format(str(limit)))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        shape = _limit_shape(limit)
+        if shape == 'int':
+            args.append(limit)
+        elif shape == 'tuple':
+            args.extend(limit)
+        sql = _compile_find_all(cls, where, kw.get('orderBy', None), shape)
+        batches = _stream(sql, args, batch)
+        try:
+            async for rs in batches:
+                for r in rs:
+                    yield cls._from_row(r)
+        finally:
+            # 显式关闭内层生成器，及时归还连接
+            await batches.aclose()
 
     @classmethod
     async def findNumber(cls, select_field, where=None, args=None):
         """ 查找条数 """
-        sql = ['select {0} as _num from `{1}`'.format(select_field, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+        sql = _compile_find_number(cls, select_field, where)
+        rs = await _select(sql, args, 1)
         if len(rs) == 0:
             return None
         return rs[0]['_num']
 
+    @classmethod
+    async def count(cls, approximate=False):
+        """ 表总行数，缓存在内存中
+
+        save/remove 时同步调整，start_count_reconciler 定时校准；
+        approximate 时首次读取 information_schema 的估算值，避免全表扫描
+        """
+        n = _table_counts.get(cls)
+        if n is None:
+            n = await _count_rows(cls, approximate)
+            _table_counts[cls] = n
+            _count_approximate[cls] = approximate
+        return n
+
     @classmethod
     async def find(cls, pk):
-        """ find object by primary key """
-        rs = await select("{0} where `{1}`=?".format(cls.__select__, cls.__primary_key__), [pk], 1)
-        if len(rs) == 0:
+        """ find object by primary key
+
+        同一轮事件循环中的并发查询会合并为一条 in 查询，
+        事务中或会话处于写后读窗口时直接查询
+        """
+        imap = _identity_map.get()
+        if imap is not None:
+            obj = imap.get((cls, pk))
+            if obj is not None:
+                return obj
+        if in_transaction() or _in_write_window():
+            rs = await _select(_compile_find(cls), [pk], 1)
+            row = rs[0] if rs else None
+        else:
+            # shield: 单个调用者被取消时不影响共用同一 future 的其他调用者
+            row = await asyncio.shield(_batch_loader(cls).load(pk))
+        if row is None:
             return None
-        return cls(**rs[0])
+        obj = cls._from_row(row)
+        if imap is not None:
+            # 同一请求中并发查询同一主键时，所有调用者得到同一对象
+            obj = imap.setdefault((cls, pk), obj)
+        return obj
+
+    @classmethod
+    async def find_many(cls, pks):
+        """ 按主键批量查询，返回与 pks 顺序一致的列表，不存在的为 None """
+        imap = _identity_map.get()
+        objs = {}
+        missing = []
+        for pk in pks:
+            obj = imap.get((cls, pk)) if imap is not None else None
+            if obj is not None:
+                objs[pk] = obj
+            elif pk not in objs:
+                objs[pk] = None
+                missing.append(pk)
+        if missing:
+            rows = await _fetch_rows(cls, missing)
+            for pk in missing:
+                row = rows.get(pk)
+                if row is not None:
+                    obj = cls._from_row(row)
+                    if imap is not None:
+                        obj = imap.setdefault((cls, pk), obj)
+                    objs[pk] = obj
+        return [objs[pk] for pk in pks]
+
+    @classmethod
+    async def save_many(cls, objs, size=500):
+        """ 批量保存，返回每批影响行数 """
+        counts = await executemany(
+            cls.__insert__, [obj._insert_args() for obj in objs], size)
+        _count_adjust(cls, sum(counts))
+        for obj in objs:
+            obj.__dict__['_changed'] = {}
+            obj._remember()
+        return counts
+
+    @classmethod
+    async def update_many(cls, objs, size=500):
+        """ 按主键批量更新，返回每批影响行数 """
+        if any(obj._deferred for obj in objs):
+            raise ValueError('update_many with deferred fields not loaded')
+        sql, columns = cls._full_update()
+        for obj in objs:
+            obj._touch()
+        counts = await _executemany(
+            sql, [obj._update_args(columns) for obj in objs], size)
+        for obj in objs:
+            obj.__dict__['_changed'] = {}
+            obj._bump_version()
+            if cls.__version_field__:
+                obj._forget()
+            else:
+                obj._remember()
+        return counts
+
+    @classmethod
+    async def upsert_many(cls, objs, update=None, size=500):
+        """ 批量插入，主键已存在时更新 update 中的字段(默认全部)
+
+        返回每批影响行数，MySQL 中更新的行计为 2
+        """
+        for obj in objs:
+            obj._touch()
+        counts = await _executemany(
+            _compile_upsert(cls, _upsert_columns(cls, update)),
+            [obj._insert_args() for obj in objs], size)
+        _count_invalidate(cls)
+        for obj in objs:
+            obj.__dict__['_changed'] = {}
+            obj._forget()
+        return counts
+
+    @classmethod
+    async def update_where(cls, set, where, args=None):
+        """ 按条件直接更新，不加载对象，返回影响行数
+
+        Blog.update_where(set={'user_name': name}, where='user_id=?', args=[uid])
+        """
+        if not set:
+            raise ValueError('update_where without fields to set')
+        columns = tuple(f for f in cls.__fields__ if f in set)
+        if len(columns) != len(set):
+            raise ValueError('Invalid field: {}'.format(
+                ','.join(f for f in set if f not in columns)))
+        if not where:
+            raise ValueError('update_where without where clause')
+        modified = cls.__modified_field__
+        if modified and modified not in columns:
+            set = dict(set, **{modified: time.time()})
+            columns = tuple(f for f in cls.__fields__ if f in set)
+        sql = _compile_update_where(cls, columns, where)
+        rows = await _execute(sql, [set[f] for f in columns] + list(args or ()))
+        _forget_model(cls)
+        return rows
+
+    @classmethod
+    async def remove_many(cls, objs, size=500):
+        """ 按主键批量删除，返回每批影响行数 """
+        pks = [obj.getValue(cls.__primary_key__) for obj in objs]
+        counts = await _execute_batches(
+            (_compile_delete_in(cls, len(batch)), batch, False)
+            for batch in (pks[i:i + size] for i in range(0, len(pks), size))
+        )
+        _count_adjust(cls, -sum(counts))
+        for obj in objs:
+            obj._forget()
+        return counts
+
+    def _touch(self):
+        """ 更新前记录修改时间 """
+        modified = self.__modified_field__
+        if modified:
+            self[modified] = time.time()
+
+    def _bump_version(self):
+        """ 数据库中版本号已加一，对象上同步 """
+        version = self.__version_field__
+        if version and dict.get(self, version) is not None:
+            dict.__setitem__(self, version, self[version] + 1)
+
+    @classmethod
+    def _full_update(cls):
+        """ 整行 update 语句(驱动可执行)和字段，有版本字段时版本号在数据库中加一 """
+        if not cls.__version_field__:
+            return _driver_sql(cls.__update__), cls.__fields__
+        columns = tuple(f for f in cls.__fields__ if f != cls.__version_field__)
+        return _compile_update(cls, columns), columns
+
+    def _remember(self):
+        """ 写入对象缓存，只缓存加载了全部字段的对象 """
+        imap = _identity_map.get()
+        if imap is not None and not self._deferred:
+            imap[(type(self), self.getValue(self.__primary_key__))] = self
+
+    def _forget(self):
+        """ 从对象缓存移除 """
+        imap = _identity_map.get()
+        if imap is not None:
+            imap.pop((type(self), self.getValue(self.__primary_key__)), None)
+
+    def _insert_args(self):
+        """ insert 语句参数 """
+        args = list(map(self.getValueOrDefault, self.__fields__))
+        args.append(self.getValueOrDefault(self.__primary_key__))
+        return args
+
+    def _update_args(self, columns=None):
+        """ update 语句参数 """
+        args = list(map(self.getValue, columns or self.__fields__))
+        args.append(self.getValue(self.__primary_key__))
+        return args
+
+    async def load(self, *names):
+        """ 加载延迟字段，默认加载全部未加载字段 """
+        names = tuple(f for f in self.__fields__
+                      if f in (names or self._deferred) and f in self._deferred)
+        if not names:
+            return self
+        rs = await _select(
+            _compile_find(type(self), names),
+            [self.getValue(self.__primary_key__)], 1)
+        if rs:
+            dict.update(self, rs[0])
+        object.__setattr__(self, '_deferred', self._deferred.difference(names))
+        return self
 
     async def save(self):
         """ 保存 """
         # pdb.set_trace()
-        args = list(map(self.getValueOrDefault, self.__fields__))
-        args.append(self.getValueOrDefault(self.__primary_key__))
+        args = self._insert_args()
         rows = await execute(self.__insert__, args)
-        logger.debug(" insert args:{}".format(args))
+        logger.debug(" insert args:%s", args)
         if rows != 1:
-            logger.info('failed to insert record : affected rows:{}'.format(rows))
+            logger.info('failed to insert record : affected rows:%s', rows)
+        else:
+            self.__dict__['_changed'] = {}
+            self._remember()
+        _count_adjust(type(self), rows)
 
     async def update(self):
-        """ 更新 """ 
-        args = list(map(self.getValue, self.__fields__))
-        args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
-        logger.debug(" update args:{}, sql:{}".format(args, self.__update__))
+        """ 更新
+
+        从数据库加载的对象只更新修改过的字段，没有修改时不执行；
+        其他对象更新全部字段
+        """ 
+        columns = self.dirty_fields()
+        if columns is None:
+            self._touch()
+            sql, columns = self._full_update()
+            args = self._update_args(columns)
+            rows = await _execute(sql, args)
+            self._bump_version()
+            # 对象上的版本号未必是数据库中的值，不放入标识映射
+            remember = not self.__version_field__
+        elif not columns:
+            logger.debug(" update skipped, nothing changed")
+            self._changed.clear()
+            return
+        else:
+            self._touch()
+            columns = self.dirty_fields()
+            sql = _compile_update(type(self), columns)
+            args = list(map(self.getValue, columns))
+            args.append(self.getValue(self.__primary_key__))
+            rows = await _execute(sql, args)
+            if self.__version_field__ not in columns:
+                self._bump_version()
+            remember = True
+        logger.debug(" update args:%s, sql:%s", args, sql)
         if rows != 1:
-            logger.info('failed to update by primary key: affected rows:{}'.format(rows))
+            logger.info('failed to update by primary key: affected rows:%s', rows)
+        self.__dict__['_changed'] = {}
+        if remember:
+            self._remember()
+        else:
+            self._forget()
+
+    async def upsert(self, update=None):
+        """ 保存，主键已存在时更新 update 中的字段(默认全部)
+
+        一条语句完成，MySQL 使用 ON DUPLICATE KEY UPDATE，
+        SQLite 使用 ON CONFLICT DO UPDATE
+        """
+        sql = _compile_upsert(type(self), _upsert_columns(type(self), update))
+        self._touch()
+        rows = await _execute(sql, self._insert_args())
+        logger.debug(" upsert affected rows:%s", rows)
+        _count_invalidate(type(self))
+        self.__dict__['_changed'] = {}
+        if update is None and not self.__version_field__:
+            self._remember()
+        else:
+            # 未更新的字段或版本号可能与数据库不一致
+            self._forget()
+        return rows
 
     async def remove(self):
         """ 删除 """
         args = [self.getValue(self.__primary_key__)]
         rows = await execute(self.__delete__, args)
+        self._forget()
+        _count_adjust(type(self), -rows)
         if rows != 1:
-            logger.info('failed to remove by primary key : affected rows:{}'.format(rows))
+            logger.info('failed to remove by primary key : affected rows:%s', rows)
+
+
+def create_table_sql(cls):
+    """ 根据模型字段生成建表语句 """
+    columns = ['`{0}` {1} not null primary key'.format(
+        cls.__primary_key__, cls.__mappings__[cls.__primary_key__].column_type)]
+    for f in cls.__fields__:
+        columns.append('`{0}` {1}'.format(f, cls.__mappings__[f].column_type))
+    return 'CREATE TABLE IF NOT EXISTS `{0}` (\n  {1}\n)'.format(
+        cls.__table__, ',\n  '.join(columns))
+
+
+def create_index_sql(cls, index):
+    """ 生成索引的建立语句 """
+    return 'CREATE {0}INDEX `{1}` ON `{2}` ({3})'.format(
+        'UNIQUE ' if index.unique else '', index.name, cls.__table__,
+        ', '.join('`{}`'.format(f) for f in index.fields))
+
+
+async def live_indexes(cls):
+    """ 数据库中模型对应表的索引 {索引名: (unique, (字段,...))} """
+    return await _backend.live_indexes(_primary_select, cls.__table__)
+
+
+async def _primary_select(sql, args):
+    """ 在主库上查询，用于读取表结构，避免从库延迟
+
+    直接使用主库连接，不开启事务，不占用写锁，也不标记会话写入
+    """
+    return await _select(_driver_sql(sql), args, pool=_primary())
+
+
+async def create_tables(*models):
+    """ 根据模型定义建表和索引，已存在时跳过 """
+    for cls in models:
+        await execute(create_table_sql(cls), ())
+        live = await live_indexes(cls)
+        for index in cls.__index_defs__:
+            if index.name not in live:
+                await execute(create_index_sql(cls, index), ())
+
+
+async def execute_script(sql):
+    """ 执行多条以 ; 分隔的语句，如 db/table.sql，语句会按后端转换 """
+    sql = _backend.translate_ddl(sql)
+    async with transaction():
+        for statement in sql.split(';'):
+            if statement.strip():
+                await execute(statement, ())
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+""" 表结构与索引维护
+
+对比模型声明的索引(字段 index/unique 和 __indexes__)与数据库中实际的索引，
+补建缺少的索引，并用 EXPLAIN 检查常用查询是否走索引。
+
+在 www 目录下运行:
+    python schema.py --diff      列出缺少和多余的索引
+    python schema.py --apply     建立缺少的索引
+    python schema.py --explain   检查常用查询的执行计划
+    python schema.py --explain --queries queries.json
+        检查运行中记录的查询，文件为 /api/schema/explain 的返回结果
+        (需开启 db.track_queries)
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import orm
+from config.env import CONF
+from models import User, Blog, Comment
+
+MODELS = (User, Blog, Comment)
+
+
+async def diff(models=MODELS):
+    """ 对比模型与数据库的索引
+
+    返回 [(model, 缺少的 Index 列表, 多余的索引名列表)]，
+    字段相同但名称不同的索引视为已存在
+    """
+    result = []
+    for cls in models:
+        live = await orm.live_indexes(cls)
+        live_columns = {v: k for k, v in live.items()}
+        missing = []
+        for index in cls.__index_defs__:
+            if (index.unique, index.fields) in live_columns:
+                live_columns.pop((index.unique, index.fields))
+            elif index.name not in live:
+                missing.append(index)
+        declared = set(i.name for i in cls.__index_defs__)
+        extra = [name for name in live_columns.values() if name not in declared]
+        result.append((cls, missing, extra))
+    return result
+
+
+async def apply(models=MODELS):
+    """ 建立缺少的索引，多余的索引只提示不删除 """
+    for cls, missing, extra in await diff(models):
+        for index in missing:
+            sql = orm.create_index_sql(cls, index)
+            print(sql)
+            await orm.execute(sql, ())
+        for name in extra:
+            print('-- {0}: index `{1}` not declared'.format(cls.__table__, name))
+
+
+async def sample_queries():
+    """ 执行站点常用查询并记录，用于 explain """
+    orm.track_queries()
+    try:
+        await User.findAll('email=?', [''])
+        await Blog.findAll(orderBy='created_at desc', limit=(0, 10))
+        await Blog.findAll(
+            seek=('created_at', 'id'), after=(time.time(), ''),
+            desc=True, limit=10, defer=['content'])
+        await Comment.findAll('id=?', [''], orderBy='created_at desc')
+        return orm.tracked_queries()
+    finally:
+        orm.track_queries(False)
+
+
+async def explain(queries):
+    """ 对每条查询执行 EXPLAIN，返回 {sql: 问题列表} """
+    backend = orm._backend
+    problems = {}
+    for sql, args in queries.items():
+        plan = await orm._select(
+            '{0} {1}'.format(backend.explain_prefix, sql), args)
+        found = backend.full_scans(plan)
+        if found:
+            problems[sql] = found
+    return problems
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--diff', action='store_true', help='列出索引差异')
+    parser.add_argument('--apply', action='store_true', help='建立缺少的索引')
+    parser.add_argument('--explain', action='store_true', help='检查查询计划')
+    parser.add_argument('--queries', help='记录的查询文件，代替常用查询')
+    args = parser.parse_args(argv)
+
+    db = dict(CONF['db'])
+    db['db'] = db.pop('dbName', None)
+    for key in ('count_interval', 'create_tables'):
+        db.pop(key, None)
+    db['ping_interval'] = 0
+    await orm.create_pool(asyncio.get_event_loop(), **db)
+
+    status = 0
+    if args.diff or not (args.apply or args.explain):
+        for cls, missing, extra in await diff():
+            for index in missing:
+                print('+ {0}'.format(orm.create_index_sql(cls, index)))
+            for name in extra:
+                print('- {0}.{1}'.format(cls.__table__, name))
+            status = status or int(bool(missing))
+    if args.apply:
+        await apply()
+    if args.explain:
+        if args.queries:
+            with open(args.queries) as f:
+                queries = json.load(f)
+            queries = queries.get('queries', queries)
+        else:
+            queries = await sample_queries()
+        for sql, found in (await explain(queries)).items():
+            print(sql)
+            for problem in found:
+                print('    ' + problem)
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    sys.exit(loop.run_until_complete(main()))
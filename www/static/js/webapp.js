@@ -1,6 +1,14 @@
 
 function showPage(page){
     s = ''
+    if (page.next_cursor !== undefined) {
+        // 键集分页
+        if (page.has_prev)
+            s+="<a href='?after='>first</a>"
+        if (page.has_next)
+            s+="<a href='?after="+page.next_cursor+"'>next</a>"
+        return s
+    }
     index = page.page_index
     if (page.has_prev)
         s+="<a href='?page="+(index-1)+"'>prev</a>"
@@ -2,13 +2,19 @@
 
 import asyncio
 import os
+import time
 import inspect
+import hashlib
+import mimetypes
 import functools
+import collections
+from email.utils import formatdate
 from urllib import parse
 from aiohttp import web
 from apis import APIError
 # import pdb
-from functions import logger
+from functions import logger, encoded_etag, etag_matches
+import compress
 
 
 def get(path):
@@ -35,6 +41,114 @@ def post(path):
     return decorator
 
 
+def cached(ttl=60, vary=(), tags=()):
+    """ 响应缓存装饰器，与 @get 一起使用
+
+    @get('/blogs')
+    @cached(ttl=300, vary=['Accept-Language'], tags=['blogs'])
+
+    :param ttl-缓存秒数
+    :param vary-参与缓存键的请求头
+    :param tags-失效标签，invalidate(tag) 清除带该标签的缓存
+    """
+    def decorator(func):
+        func.__cache__ = dict(
+            ttl=ttl,
+            vary=tuple(vary),
+            tags=frozenset(tags) or frozenset([func.__name__])
+        )
+        return func
+    return decorator
+
+
+class ResponseCache(object):
+    """ 内存响应缓存，保存最终响应的 body 和 headers
+
+    同一个键的并发未命中只执行一次处理函数
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()  # 键 => (过期时间, 标签, body, headers)
+        self._pending = {}  # 键 => 正在生成响应的 future
+        self._generation = 0  # 每次失效加一，生成期间失效的响应不写入
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ 获取未过期的缓存 (body, headers) """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[2], entry[3]
+
+    def set(self, key, ttl, tags, body, headers, generation=None):
+        """ 写入缓存，generation 与当前不同时说明期间已失效，不写入 """
+        if generation is not None and generation != self._generation:
+            return
+        self._entries[key] = (time.monotonic() + ttl, tags, body, headers)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def fetch(self, key, policy, build):
+        """ 读取缓存，未命中时调用 build() 生成 (response, body, headers)
+
+        返回 (response, body, headers)，命中缓存时 response 为 None；
+        build 返回的 body 为 None 表示响应不可缓存
+        """
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return (None,) + cached
+        self.misses += 1
+        pending = self._pending.get(key)
+        if pending is not None:
+            # 等待同一个键正在生成的响应
+            cached = await asyncio.shield(pending)
+            if cached is not None:
+                return (None,) + cached
+            return await build()
+        fut = self._pending[key] = asyncio.get_event_loop().create_future()
+        generation = self._generation
+        cached = None
+        try:
+            resp, body, headers = await build()
+            if body is not None:
+                cached = (body, headers)
+                self.set(key, policy['ttl'], policy['tags'],
+                         body, headers, generation)
+            return resp, body, headers
+        finally:
+            del self._pending[key]
+            fut.set_result(cached)
+
+    def invalidate(self, *tags):
+        """ 清除带有任一标签的缓存，不传标签时清除全部 """
+        self._generation += 1
+        if not tags:
+            self._entries.clear()
+            return
+        tags = frozenset(tags)
+        for key in [k for k, v in self._entries.items() if v[1] & tags]:
+            del self._entries[key]
+
+    def stats(self):
+        return dict(entries=len(self._entries), hits=self.hits, misses=self.misses)
+
+
+response_cache = ResponseCache()
+
+
+def invalidate(*tags):
+    """ 清除响应缓存，在修改数据的接口中调用 """
+    response_cache.invalidate(*tags)
+
+
 def get_required_kw_args(fn):
     """ 获取没有默认值的命名关键字参数 """
     args = []
@@ -92,66 +206,112 @@ def has_request_arg(fn):
     return found
 
 
+def _to_bool(value):
+    """ 请求参数转换为 bool """
+    if isinstance(value, bool):
+        return value
+    value = str(value).lower()
+    if value in ('1', 'true', 'yes', 'on'):
+        return True
+    if value in ('0', 'false', 'no', 'off', ''):
+        return False
+    raise ValueError(value)
+
+
+def get_coercions(fn):
+    """ 获取参数的类型转换函数，由注解或默认值类型决定，如 page: int, page=1 """
+    coercions = {}
+    params = inspect.signature(fn).parameters
+    for name, param in params.items():
+        kind = param.annotation
+        if (kind is inspect.Parameter.empty and
+                param.default is not inspect.Parameter.empty and
+                param.default is not None):
+            kind = type(param.default)
+        if kind is bool:
+            coercions[name] = _to_bool
+        elif kind in (int, float):
+            coercions[name] = kind
+    return coercions
+
+
 class RequestHandler(object):
-    """ 请求处理器 """
+    """ 请求处理器
+
+    注册路由时根据处理函数签名确定需要的参数，请求时只取这些参数
+    """
 
     def __init__(self, app, fn):
         self._app = app
         self._func = fn
+        self.cache_policy = getattr(fn, '__cache__', None)  # @cached 设置的缓存策略
         self._has_request_arg = has_request_arg(fn)  # 是否有request
         self._has_var_kw_arg = has_var_kw_arg(fn)  # 是否有关键字参数 **kw
         self._has_named_kw_args = has_named_kw_args(fn)  # 是否有命名关键字参数
         self._named_kw_args = get_named_kw_args(fn)  # 获取所有 命名关键字 参数
         self._required_kw_args = get_required_kw_args(fn)  # 获取 没有默认值的命名关键字参数
+        # 是否解析查询字符串和请求体
+        self._parse_params = bool(self._has_var_kw_arg or self._named_kw_args)
+        # 要取的参数名，None 表示全部(**kw)
+        self._param_names = None if self._has_var_kw_arg else self._named_kw_args
+        self._coercions = get_coercions(fn)  # 参数类型转换
+        # 没有其他参数时，请求体作为 data 参数
+        self._stream_arg = (self._has_var_kw_arg or
+                            'data' in inspect.signature(fn).parameters)
+        self._name = fn.__name__
+
+    def _pick_query(self, qs):
+        """ 解析查询字符串，只保留需要的参数，同名参数取第一个 """
+        names = self._param_names
+        kw = {}
+        for k, v in parse.parse_qsl(qs, True):
+            if (names is None or k in names) and k not in kw:
+                kw[k] = v
+        return kw
+
+    def _pick(self, params):
+        """ 从请求参数中取出处理函数需要的参数 """
+        if self._param_names is None:
+            return dict(params)
+        return {name: params[name]
+                for name in self._param_names if name in params}
+
+    async def _parse(self, request):
+        """ 解析请求参数，返回参数 dict、None(无参数) 或错误响应 """
+        if request.method == 'POST':
+            # POST请求预处理，处理各种内容类型
+            if not request.content_type:
+                return web.HTTPBadRequest(reason='Missing Content-type')
+            ct = request.content_type.lower()
+            if ct.startswith('application/json'):
+                params = await request.json()
+                if not isinstance(params, dict):
+                    return web.HTTPBadRequest(
+                        reason='Json body must be object')
+                return self._pick(params)
+            if (ct.startswith('application/x-www-form-urlencoded') or
+                    ct.startswith('multipart/form-data')):
+                return self._pick(await request.post())
+            return web.HTTPBadRequest(
+                reason='Unsupported Content-Type: {0}'
+                ''.format(request.content_type),
+                content_type=request.content_type
+                )
+        if request.method == 'GET' and request.query_string:
+            return self._pick_query(request.query_string)
+        return None
 
     async def __call__(self, request):
         """ 分析请求, 整理参数 """
         kw = None
-        if (self._has_var_kw_arg or
-                self._has_named_kw_args or
-                self._required_kw_args):
-            # pdb.set_trace()
-            if request.method == 'POST':
-                # POST请求预处理，处理各种内容类型
-                if not request.content_type:
-                    return web.HTTPBadRequest(reason='Missing Content-type')
-                ct = request.content_type.lower()
-                if ct.startswith('application/json'):
-                    params = await request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest(
-                            reason='Json body must be object')
-                    kw = params
-
-                elif (ct.startswith('application/x-www-form-urlencoded') or
-                        ct.startswith('multipart/form-data')):
-                    params = await request.post()
-                    kw = dict(**params)
-
-                else:
-                    return web.HTTPBadRequest(
-                        reason='Unsupported Content-Type: {0}'
-                        ''.format(request.content_type),
-                        content_type=request.content_type
-                        )
-
-            if request.method == 'GET':
-                qs = request.query_string
-                if qs:
-                    kw = {}
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
+        if self._parse_params:
+            kw = await self._parse(request)
+            if kw is not None and not isinstance(kw, dict):
+                return kw
 
         if kw is None:
-            kw = dict(**request.match_info)
-        else:
-            if (not self._has_var_kw_arg) and self._named_kw_args:
-                # 获取命名关键字
-                copy = {}
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
+            kw = dict(request.match_info)
+        elif request.match_info:
             for k, v in request.match_info.items():
                 if k in kw:
                     logger.warning(
@@ -159,6 +319,13 @@ class RequestHandler(object):
                         'arg and kw args{0}'.format(k)
                         )
                 kw[k] = v
+        for name, coerce in self._coercions.items():
+            if name in kw:
+                try:
+                    kw[name] = coerce(kw[name])
+                except (TypeError, ValueError):
+                    return web.HTTPBadRequest(
+                        reason='Invalid argument:{0}'.format(name))
         if self._has_request_arg:
             kw['request'] = request
         if self._required_kw_args:
@@ -167,14 +334,14 @@ class RequestHandler(object):
                 if not (name in kw):
                     return web.HTTPBadRequest(
                         reason='Missing argument:{0}'.format(name))
-        if not kw:
+        if not kw and self._stream_arg:
             # stream request
             stream_data = await request.read()
             if stream_data:
-                logger.info("stream request: {}".format(stream_data.decode('utf-8')))
+                logger.debug("stream request: %s", stream_data)
                 kw['data'] = stream_data.decode('utf-8')
 
-        logger.info('call with args:{0}'.format(str(kw)))
+        logger.debug('call %s with args:%s', self._name, kw)
         try:
             r = await self._func(**kw)
             return r
@@ -182,11 +349,104 @@ class RequestHandler(object):
             return dict(error=e.error, data=e.data, message=e.message)
 
 
+class StaticFiles(object):
+    """ 内存静态文件，启动时读取全部文件并预先压缩
+
+    请求时只按 Accept-Encoding 选择已压缩的内容，不再读文件和压缩。
+    每个文件同时以带内容哈希的文件名提供，如 js/webapp.3f2a1b9c0d.js，
+    内容变化后地址随之变化，因此可以让浏览器永久缓存
+    """
+    PREFIX = '/static/'
+    # 带哈希的地址永久缓存，原地址每次使用前验证
+    IMMUTABLE = 'public, max-age=31536000, immutable'
+    REVALIDATE = 'no-cache'
+
+    def __init__(self, root):
+        self.root = root
+        self._files = {}  # 相对路径 => (headers, {编码: body})
+        self.manifest = {}  # 相对路径 => 带哈希的相对路径
+        self.version = None
+        self.load()
+
+    def load(self):
+        """ 读取并压缩 root 下的全部文件，生成 manifest """
+        files = {}
+        manifest = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                headers, bodies, digest = self._load(path)
+                base, ext = os.path.splitext(name)
+                fingerprinted = '{0}.{1}{2}'.format(base, digest[:10], ext)
+                files[name] = (
+                    dict(headers, **{'Cache-Control': self.REVALIDATE}), bodies)
+                files[fingerprinted] = (
+                    dict(headers, **{'Cache-Control': self.IMMUTABLE}), bodies)
+                manifest[name] = fingerprinted
+        self._files = files
+        self.manifest = manifest
+        # 全部文件内容的摘要，静态文件变化后页面的 ETag 随之变化
+        self.version = hashlib.sha1(
+            repr(sorted(manifest.items())).encode('utf-8')).hexdigest()[:10]
+        logger.info("static files loaded: %s from %s", len(manifest), self.root)
+
+    def url(self, name):
+        """ 静态文件的带哈希地址，模板中使用 asset_url('js/webapp.js') """
+        return self.PREFIX + self.manifest.get(name, name)
+
+    def _load(self, path):
+        with open(path, 'rb') as f:
+            body = f.read()
+        digest = hashlib.sha1(body).hexdigest()
+        content_type = mimetypes.guess_type(path)[0]
+        content_type = content_type or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type.endswith('javascript'):
+            content_type += '; charset=utf-8'
+        headers = {
+            'Content-Type': content_type,
+            'ETag': '"{}"'.format(digest[:16]),
+            'Last-Modified': formatdate(os.path.getmtime(path), usegmt=True)
+        }
+        bodies = {None: body}
+        if compress.compressible(content_type):
+            headers['Vary'] = 'Accept-Encoding'
+            for encoding in compress.encodings():
+                # 静态文件只压缩一次，使用最高级别
+                data = compress.compress(
+                    body, encoding, 11 if encoding == 'br' else 9)
+                if len(data) < len(body):
+                    bodies[encoding] = data
+        return headers, bodies, digest
+
+    async def __call__(self, request):
+        entry = self._files.get(request.match_info['path'])
+        if entry is None:
+            raise web.HTTPNotFound()
+        headers, bodies = entry
+        encoding = compress.negotiate(
+            request.headers.get('Accept-Encoding'),
+            tuple(e for e in bodies if e is not None))
+        headers = dict(headers)
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+            headers['ETag'] = encoded_etag(headers['ETag'], encoding)
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None and etag_matches(
+                if_none_match, entry[0]['ETag']):
+            headers.pop('Content-Type')
+            headers.pop('Content-Encoding', None)
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=bodies[encoding], headers=headers)
+
+
 def add_static(app):
-    """ 添加静态资源路径 """
+    """ 添加静态资源路径，文件在启动时读入内存并预先压缩 """
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    app.router.add_static('/static/', path)
-    logger.info("add static {0} => {1}".format('/static/', path))
+    app['__static__'] = StaticFiles(path)
+    app['__asset_version__'] = app['__static__'].version
+    app.router.add_get(StaticFiles.PREFIX + '{path:.+}', app['__static__'])
+    logger.info("add static {0} => {1}".format(StaticFiles.PREFIX, path))
 
 
 def add_route(app, fn):
@@ -2,7 +2,7 @@
 
 from module.rediscache.Cache import Cache
 from config.env import CONF
-from functions import logger
+from functions import wechat_logger as logger
 from urllib import request
 import json
 
@@ -14,14 +14,11 @@ def access_token_cache():
         postUrl = CONF['url']['access_token_url']
         urlResp = request.urlopen(postUrl)
         urlResp = json.loads(urlResp.read())
-        logger.debug("[wechat] access_token: {} {}".format(urlResp, postUrl))
+        logger.debug("[wechat] access_token: %s %s", urlResp, postUrl)
         return urlResp['access_token']
     except Exception:
-        logger.warning("[wechat] access_token error: {} {}".format(
-                urlResp,
-                postUrl
-            )
-        )
+        logger.warning(
+            "[wechat] access_token error: %s %s", urlResp, postUrl)
         return ''
 
 
@@ -1,7 +1,7 @@
 # coding:utf-8
 """ 消息处理 """
 import xml.etree.ElementTree as ET
-from functions import logger
+from functions import wechat_logger as logger
 import time
 
 
@@ -10,7 +10,7 @@ class MsgHandle(object):
     def __init__(self, xml_data):
         # 数据解析
         self.data = self._parse_xml(xml_data)
-        logger.info('[wechat] receive msg_data :%s' % str(self.data))
+        logger.info('[wechat] receive msg_data :%s', self.data)
         # 消息类型
         self.type = self.data.find('MsgType').text
         # 转换为消息对象
@@ -92,7 +92,7 @@ class TextMsg(Msg):
             <Content><![CDATA[{Content}]]></Content>
             </xml>
         """
-        logger.info('[wechat] reply msg_data: %s' % str(xml_form))
+        logger.info('[wechat] reply msg_data: %s', xml_form)
         return xml_form.format(**msg_data)
 
     def ai(self, content):